@@ -0,0 +1,93 @@
+import torch
+
+@torch.no_grad()
+def beam_search(model, source, source_mask, sos_idx: int, eos_idx: int, pad_idx: int, beam_size: int, max_len: int, length_penalty: float=1.0, early_stopping: bool=True):
+    # source: (batch, seq_len), source_mask: (batch, 1, 1, seq_len)
+    # All the beams of all the sentences are decoded together as one (batch * beam_size, len) tensor,
+    # so every step is a single forward pass through the decoder.
+    batch_size = source.size(0)
+    device = source.device
+
+    # Precompute the encoder output and repeat it for every beam: (batch * beam_size, seq_len, d_model)
+    encoder_output = model.encode(source, source_mask)
+    beam_origin = torch.arange(batch_size, device=device).repeat_interleave(beam_size)
+    encoder_output = encoder_output.index_select(0, beam_origin)
+    source_mask = source_mask.index_select(0, beam_origin)
+    cache = model.init_cache()
+
+    # Every beam starts with the sos token. Only the first beam is live at the first step,
+    # otherwise the best candidates would be beam_size copies of the same sentence
+    tokens = torch.full((batch_size * beam_size, 1), sos_idx, dtype=torch.int64, device=device)
+    beam_scores = torch.zeros(batch_size, beam_size, device=device)
+    beam_scores[:, 1:] = float('-inf')
+
+    # Best finished hypotheses of each sentence and their length normalized scores
+    finished_tokens = torch.full((batch_size, beam_size, max_len), pad_idx, dtype=torch.int64, device=device)
+    finished_scores = torch.full((batch_size, beam_size), float('-inf'), device=device)
+    done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    # Offset of the first beam of each sentence in the (batch * beam_size) layout
+    batch_offset = (torch.arange(batch_size, device=device) * beam_size).unsqueeze(1) # (batch, 1)
+
+    while tokens.size(1) < max_len:
+        # Only the newest token of every beam is fed in, the previous ones are in the cache
+        out = model.decode(encoder_output, source_mask, tokens[:, -1:], None, cache)
+        # Scores are summed log probabilities, so normalize the logits first
+        log_probs = torch.log_softmax(model.project(out[:, -1]).float(), dim=-1) # (batch * beam_size, vocab_size)
+        vocab_size = log_probs.size(-1)
+
+        # Score every (beam, token) continuation and select over the flattened beams of each sentence
+        # 2 * beam_size candidates always leave beam_size candidates that do not end with eos
+        candidate_scores = (beam_scores.view(-1, 1) + log_probs).view(batch_size, -1) # (batch, beam_size * vocab_size)
+        top_scores, top_idx = torch.topk(candidate_scores, 2 * beam_size, dim=1) # (batch, 2 * beam_size)
+        top_parents = batch_offset + top_idx // vocab_size
+        top_tokens = top_idx % vocab_size
+        is_eos = top_tokens == eos_idx
+        # Number of generated tokens (sos excluded) once the new token is appended
+        hyp_len = tokens.size(1)
+
+        # Candidates ending with eos among the beam_size best ones compete with the finished hypotheses
+        eos_scores = (top_scores / hyp_len ** length_penalty).masked_fill(~is_eos, float('-inf'))
+        eos_scores[:, beam_size:] = float('-inf')
+        eos_scores.masked_fill_(done.unsqueeze(1), float('-inf'))
+        eos_sequences = torch.full((batch_size, 2 * beam_size, max_len), pad_idx, dtype=torch.int64, device=device)
+        eos_sequences[:, :, :hyp_len] = tokens.index_select(0, top_parents.view(-1)).view(batch_size, 2 * beam_size, hyp_len)
+        eos_sequences[:, :, hyp_len] = eos_idx
+        finished_scores, keep = torch.topk(torch.cat([finished_scores, eos_scores], dim=1), beam_size, dim=1)
+        finished_tokens = torch.cat([finished_tokens, eos_sequences], dim=1).gather(1, keep.unsqueeze(-1).expand(-1, -1, max_len))
+
+        # The live beams are the best candidates that do not end with eos
+        beam_scores, live_idx = torch.topk(top_scores.masked_fill(is_eos, float('-inf')), beam_size, dim=1)
+        parents = top_parents.gather(1, live_idx).view(-1) # (batch * beam_size)
+        next_tokens = top_tokens.gather(1, live_idx).view(-1, 1) # (batch * beam_size, 1)
+        tokens = torch.cat([tokens.index_select(0, parents), next_tokens], dim=1)
+        # The parents are beams of the same sentence: only the self-attention cache has to follow them
+        model.reorder_cache(cache, parents)
+
+        # A sentence is done once it has beam_size finished hypotheses. Without early stopping it goes on
+        # until its best live beam, normalized at the current length, can no longer beat the worst of them
+        if early_stopping:
+            done |= finished_scores[:, -1] > float('-inf')
+        else:
+            done |= finished_scores[:, -1] >= beam_scores[:, 0] / hyp_len ** length_penalty
+        if done.all():
+            break
+
+    # Sentences that are not done also consider their live beams, which were cut by max_len
+    live_scores = (beam_scores / max(tokens.size(1) - 1, 1) ** length_penalty).masked_fill(done.unsqueeze(1), float('-inf'))
+    live_tokens = torch.full((batch_size, beam_size, max_len), pad_idx, dtype=torch.int64, device=device)
+    live_tokens[:, :, :tokens.size(1)] = tokens.view(batch_size, beam_size, -1)
+    best_scores, best = torch.max(torch.cat([finished_scores, live_scores], dim=1), dim=1)
+    best_tokens = torch.cat([finished_tokens, live_tokens], dim=1)[torch.arange(batch_size, device=device), best] # (batch, max_len)
+
+    # Trim the padding shared by all the sentences
+    length = int((best_tokens != pad_idx).sum(dim=1).max())
+    return best_tokens[:, :length], best_scores
+
+def beam_search_decode(model, beam_size, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, length_penalty=1.0, early_stopping=True):
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+
+    tokens, _ = beam_search(model, source.to(device), source_mask.to(device), sos_idx, eos_idx, pad_idx, beam_size, max_len, length_penalty, early_stopping)
+    # Return the best candidate of the (single) sentence
+    return tokens.squeeze(0)
@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+
+# The script is run from the repository root, its modules are imported from there
+sys.path.insert(0, os.getcwd())
+from export import StepRunner
+from model import build_transformer
+
+# Per-token greedy decoding latency on CPU: the eager model with its KV cache against the step graphs of
+# export.py, run as they are, traced or compiled. The model has random weights, every run decodes --tokens steps.
+# Run from the repository root: python benchmarks/bench_compiled.py
+
+@torch.no_grad()
+def eager_decode(model, source, source_mask, steps: int):
+    encoder_output = model.encode(source, source_mask)
+    cache = model.init_cache()
+    token = torch.zeros(source.size(0), 1, dtype=torch.int64)
+    for _ in range(steps):
+        out = model.decode(encoder_output, source_mask, token, None, cache)
+        token = model.project(out[:, -1]).argmax(dim=-1, keepdim=True)
+    return token
+
+def runner_decode(runner, source, source_mask, steps: int):
+    for step, token in enumerate(runner.generate(source, source_mask, 0, 1)):
+        if step + 1 == steps:
+            return token
+
+def bench(decode, repeats: int):
+    start = time.perf_counter()
+    decode()
+    first = time.perf_counter() - start
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        decode()
+        times.append(time.perf_counter() - start)
+    return first, sorted(times)[len(times) // 2]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Eager vs traced vs compiled per-token decoding latency')
+    parser.add_argument('--backends', nargs='+', default=['eager', 'trace', 'compile'])
+    parser.add_argument('--vocab-size', type=int, default=16000)
+    parser.add_argument('--d-model', type=int, default=512)
+    parser.add_argument('--src-len', type=int, default=40)
+    parser.add_argument('--tokens', type=int, default=40)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = build_transformer(args.vocab_size, args.vocab_size, 350, 350, d_model=args.d_model, attention_backend='sdpa').eval()
+    source = torch.randint(4, args.vocab_size, (args.batch_size, args.src_len))
+    source_mask = torch.ones(args.batch_size, 1, 1, args.src_len, dtype=torch.bool)
+
+    first, median = bench(lambda: eager_decode(model, source, source_mask, args.tokens), args.repeats)
+    print(f"{'model':>8}: first run {1000 * first:8.1f} ms  {1000 * median / args.tokens:7.2f} ms/token")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for backend in args.backends:
+            # Cold: graphs built in this process, warm: a new runner loading them from the disk cache
+            for start in ('cold', 'warm'):
+                runner = StepRunner(model, backend, cache_dir, 'bench')
+                first, median = bench(lambda: runner_decode(runner, source, source_mask, args.tokens), args.repeats)
+                print(f"{backend:>8}: {start} first run {1000 * first:8.1f} ms  {1000 * median / args.tokens:7.2f} ms/token")
@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Training throughput of the gloo data-parallel mode at 1/2/4/8 processes, on synthetic batches.
+# Run from the repository root: python benchmarks/bench_ddp_scaling.py
+# Each measurement runs this same file under torchrun as a worker.
+
+def worker(args):
+    import torch
+    import torch.nn as nn
+    import torch.distributed as dist
+    from torch.nn.parallel import DistributedDataParallel
+
+    sys.path.insert(0, os.getcwd())
+    from dataset import causal_mask
+    from distributed import init_distributed, get_rank, get_world_size
+    from model import build_transformer
+
+    config = {'dist_backend': 'gloo', 'threads_per_process': args.threads_per_process}
+    device = init_distributed(config)
+    torch.manual_seed(get_rank())
+    model = DistributedDataParallel(build_transformer(args.vocab_size, args.vocab_size, args.seq_len, args.seq_len, d_model=args.d_model, N=args.layers, attention_backend='sdpa').to(device), broadcast_buffers=False)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4, eps=1e-9)
+    loss_fn = nn.CrossEntropyLoss()
+
+    # Same batch every step: the benchmark measures the training step, not the data loading
+    src = torch.randint(4, args.vocab_size, (args.batch_size, args.seq_len), device=device)
+    tgt = torch.randint(4, args.vocab_size, (args.batch_size, args.seq_len), device=device)
+    src_mask = torch.ones(args.batch_size, 1, 1, args.seq_len, dtype=torch.bool, device=device)
+    tgt_mask = causal_mask(args.seq_len, device).unsqueeze(0)
+
+    def step():
+        proj_output = model(src, src_mask, tgt, tgt_mask)
+        loss = loss_fn(proj_output.view(-1, args.vocab_size), tgt.view(-1))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    for _ in range(args.warmup):
+        step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    if get_rank() == 0:
+        tokens = args.steps * args.batch_size * args.seq_len * get_world_size()
+        print(json.dumps({'processes': get_world_size(), 'tokens_per_sec': tokens / elapsed, 'step_s': elapsed / args.steps}))
+    dist.destroy_process_group()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scaling of the gloo data-parallel training with the number of processes')
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--threads-per-process', type=int, default=0, help='0: the cores of the host divided by the processes')
+    parser.add_argument('--batch-size', type=int, default=8, help='batch of each process')
+    parser.add_argument('--seq-len', type=int, default=64)
+    parser.add_argument('--d-model', type=int, default=256)
+    parser.add_argument('--layers', type=int, default=3)
+    parser.add_argument('--vocab-size', type=int, default=16000)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        sys.exit()
+
+    worker_args = [
+        f'--threads-per-process={args.threads_per_process}', f'--batch-size={args.batch_size}', f'--seq-len={args.seq_len}',
+        f'--d-model={args.d_model}', f'--layers={args.layers}', f'--vocab-size={args.vocab_size}', f'--warmup={args.warmup}', f'--steps={args.steps}',
+    ]
+    baseline = None
+    for processes in args.processes:
+        command = [sys.executable, '-m', 'torch.distributed.run', '--standalone', f'--nproc_per_node={processes}', __file__, '--worker'] + worker_args
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        baseline = baseline or timings['tokens_per_sec']
+        speedup = timings['tokens_per_sec'] / baseline
+        print(f"{processes:>3} processes: {timings['tokens_per_sec']:10.0f} tokens/s  step {1000 * timings['step_s']:8.1f} ms  speedup {speedup:5.2f}x  efficiency {100 * speedup * args.processes[0] / processes:5.1f}%")
@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+# The script is run from the repository root, its modules are imported from there
+sys.path.insert(0, os.getcwd())
+from model import LayerNormalization
+
+# Time of one LayerNormalization, forward and forward + backward, with the explicit ops, the fused F.layer_norm
+# kernel and the explicit ops compiled by torch.compile, on the same random parameters.
+# Run from the repository root: python benchmarks/bench_layernorm.py
+
+def bench(fn, repeats: int):
+    for _ in range(10):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+def forward_backward(norm, x):
+    norm(x).sum().backward()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Explicit vs fused vs compiled LayerNormalization')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--seq-len', type=int, default=350)
+    parser.add_argument('--d-model', type=int, default=512)
+    parser.add_argument('--dtype', choices=['fp32', 'bf16'], default='fp32')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--no-compile', action='store_true')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    dtype = torch.bfloat16 if args.dtype == 'bf16' else torch.float32
+    x = torch.randn(args.batch_size, args.seq_len, args.d_model, device=device).to(dtype) # (batch, seq_len, d_model)
+    explicit = LayerNormalization(args.d_model).to(device)
+    with torch.no_grad():
+        # Trained-like parameters, not the ones / zeros of the initialization
+        explicit.alpha.normal_(1.0, 0.1)
+        explicit.bias.normal_(0.0, 0.1)
+    fused = LayerNormalization(args.d_model, backend='fused').to(device)
+    fused.load_state_dict(explicit.state_dict())
+    norms = {'explicit': explicit, 'fused': fused}
+    if not args.no_compile:
+        norms['compiled'] = torch.compile(explicit)
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        reference = explicit(x).float()
+    print(f"x: {tuple(x.shape)} {args.dtype} on {device}")
+    for name, norm in norms.items():
+        with torch.no_grad():
+            diff = (norm(x).float() - reference).abs().max().item()
+            forward = bench(lambda: (norm(x), sync()), args.repeats)
+        x_grad = x.detach().requires_grad_()
+        backward = bench(lambda: (forward_backward(norm, x_grad), sync()), args.repeats)
+        print(f"{name:>9}: forward {1e6 * forward:9.1f} us  forward + backward {1e6 * backward:9.1f} us  max difference {diff:.2e}")
@@ -0,0 +1,35 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# Load time and peak RSS of the latest weights, from the training checkpoint and from the memory-mapped
+# inference weights file, each in a fresh interpreter. Run from the repository root: python benchmarks/bench_load.py
+CHILD = r'''
+import json, resource, sys, time
+import torch
+from config import get_config, latest_weights_file_path
+from weights_file import load_weights
+config = get_config()
+start = time.perf_counter()
+if sys.argv[1] == 'checkpoint':
+    state_dict = torch.load(latest_weights_file_path(config), map_location='cpu')['model_state_dict']
+else:
+    state_dict = load_weights(latest_weights_file_path(config, '.safetensors'))
+loaded = time.perf_counter()
+# Touch every weight, as the first forward pass does
+total = sum(float(tensor.float().sum()) for tensor in state_dict.values())
+touched = time.perf_counter()
+print(json.dumps({'load_s': loaded - start, 'touch_s': touched - loaded, 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+'''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Training checkpoint vs memory-mapped weights loading')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for kind in ('checkpoint', 'mmap'):
+        for _ in range(args.repeats):
+            result = subprocess.run([sys.executable, '-c', CHILD, kind], capture_output=True, text=True, check=True)
+            timings = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f"{kind:>10}: load {1000 * timings['load_s']:8.1f} ms  touch {1000 * timings['touch_s']:8.1f} ms  max RSS {timings['max_rss_mb']:8.1f} MB")
@@ -0,0 +1,42 @@
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import torch
+
+# The script is run from the repository root, its modules are imported from there
+sys.path.insert(0, os.getcwd())
+from model import ProjectionLayer
+from shortlist import ShortlistProjection
+
+# Time of one decoding step of the output projection, over the full vocabulary and over a shortlist.
+# Run from the repository root: python benchmarks/bench_shortlist.py
+
+def bench(fn, x, repeats: int):
+    for _ in range(10):
+        fn(x)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(x)
+    return (time.perf_counter() - start) / repeats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Full vs shortlist output projection')
+    parser.add_argument('--d-model', type=int, default=512)
+    parser.add_argument('--vocab-sizes', type=int, nargs='+', default=[16000, 32000, 64000])
+    parser.add_argument('--candidates', type=int, default=1500, help='shortlist size of a sentence')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    x = torch.randn(args.batch_size, args.d_model)
+    for vocab_size in args.vocab_sizes:
+        layer = ProjectionLayer(args.d_model, vocab_size).eval()
+        model = SimpleNamespace(projection_layer=layer, project=layer)
+        candidates = torch.randperm(vocab_size)[:args.candidates].sort().values
+        full = bench(layer, x, args.repeats)
+        short = bench(ShortlistProjection(model, candidates), x, args.repeats)
+        print(f"vocab {vocab_size:>6}: full {1000 * full:7.3f} ms  shortlist {1000 * short:7.3f} ms  speedup {full / short:5.1f}x")
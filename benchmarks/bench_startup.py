@@ -0,0 +1,50 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Each run is a fresh interpreter, as for a short-lived translation worker.
+# Run from the repository root: python benchmarks/bench_startup.py
+CHILD = r'''
+import json, sys, time
+start = time.perf_counter()
+import translate
+import torch
+imported = time.perf_counter()
+with_model = '--no-model' not in sys.argv
+timings = {'import_s': imported - start}
+if with_model:
+    translator = translate.Translator()
+    loaded = time.perf_counter()
+    timings['load_s'] = loaded - imported
+    # First token: encode the source and run one decoder step
+    with torch.no_grad():
+        source, source_mask = translator.make_source([translator.encode(sys.argv[1])])
+        encoder_output = translator.model.encode(source, source_mask)
+        cache = translator.model.init_cache()
+        decoder_input = torch.full((1, 1), translator.tokenizer_tgt.token_to_id('[SOS]'), dtype=torch.int64, device=translator.device)
+        out = translator.model.decode(encoder_output, source_mask, decoder_input, None, cache)
+        next_word = translator.model.project(out[:, -1]).argmax(dim=1).item()
+    first_token = time.perf_counter()
+    timings['first_token_s'] = first_token - loaded
+    timings['total_s'] = first_token - start
+print(json.dumps(timings))
+'''
+
+def run_once(sentence: str, no_model: bool):
+    args = [sys.executable, '-c', CHILD, sentence] + (['--no-model'] if no_model else [])
+    result = subprocess.run(args, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start time of translate.py: import, model load and first token')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--sentence', default='I am not a very good a student.')
+    parser.add_argument('--no-model', action='store_true', help='only measure the import time, no weights needed')
+    args = parser.parse_args()
+
+    runs = [run_once(args.sentence, args.no_model) for _ in range(args.repeats)]
+    for key in runs[0]:
+        values = [run[key] for run in runs]
+        print(f"{key:>16}: median {1000 * statistics.median(values):8.1f} ms  min {1000 * min(values):8.1f} ms")
@@ -0,0 +1,88 @@
+import os
+import queue
+import threading
+from pathlib import Path
+
+import torch
+
+from weights_file import save_weights
+
+def to_cpu(state):
+    # Copy of the state with every tensor copied to the CPU. The copy is needed even for CPU tensors:
+    # training goes on updating the weights and the optimizer state while the checkpoint is written
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+def atomic_write(path, write):
+    # Write to a temporary file then rename it: an interrupted write never leaves a truncated file at path
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    write(tmp_path)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class AsyncCheckpointWriter:
+
+    def __init__(self, keep_last: int=0, list_checkpoints=None):
+        # keep_last: number of checkpoints kept on disk, 0 keeps them all.
+        # list_checkpoints: returns the checkpoint paths from the oldest to the latest, for the retention
+        self.keep_last = keep_last
+        self.list_checkpoints = list_checkpoints
+        # A single pending checkpoint: when the previous one is still being written, save() waits for it
+        # rather than holding more copies of the state in memory
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def save(self, path, state, weights_path=None):
+        # The state is copied now, training can go on as soon as save() returns.
+        # With weights_path the model weights are also written as an inference weights file, see weights_file.py
+        self._raise_error()
+        self.queue.put((path, to_cpu(state), weights_path))
+
+    def wait(self):
+        # Block until every checkpoint given to save() is on disk
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.worker.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing the checkpoint failed') from error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            path, state, weights_path = item
+            try:
+                if weights_path is not None:
+                    atomic_write(weights_path, lambda tmp_path: save_weights(state['model_state_dict'], tmp_path))
+                # The training checkpoint is written last: once preload can find it, its weights file exists too
+                atomic_write(path, lambda tmp_path: torch.save(state, tmp_path))
+                self._remove_old_checkpoints()
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _remove_old_checkpoints(self):
+        if not self.keep_last or self.list_checkpoints is None:
+            return
+        for path in self.list_checkpoints()[:-self.keep_last]:
+            Path(path).unlink(missing_ok=True)
+            Path(path).with_suffix('.safetensors').unlink(missing_ok=True)
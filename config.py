@@ -3,31 +3,83 @@ from pathlib import Path
 def get_config():
     return {
         "batch_size": 8,
+        "val_batch_size": 1,
+        "dynamic_batching": False,
+        "max_tokens": 4096,
+        "num_workers": 0,
+        "persistent_workers": True,
+        "prefetch_factor": 2,
+        "pin_memory": False,
         "num_epochs": 20,
         "lr": 10**-4,
+        "lr_schedule": "constant",
+        "warmup_steps": 4000,
+        "lr_scaling": False,
+        "lr_reference_batch_size": 8,
+        "optimizer_impl": "default",
+        "precision": "fp32",
+        "grad_accum_steps": 1,
+        "activation_checkpointing": False,
+        "dist_backend": "gloo",
+        "threads_per_process": 0,
         "seq_len": 350,
         "d_model": 512,
+        "attention_backend": "sdpa",
+        "layer_norm_backend": "fused",
+        "inference_quantization": None,
+        "inference_backend": "eager",
+        "compile_cache_dir": "compile_cache",
+        "onnx_folder": "onnx",
+        "onnx_threads": 0,
+        "shortlist": False,
+        "shortlist_file": "shortlist.npz",
+        "shortlist_top_k": 50,
+        "shortlist_frequent": 500,
+        "shortlist_min_prob": 0.5,
         "datasource": 'opus_books',
         "lang_src": "en",
         "lang_tgt": "it",
         "model_folder": "weights",
         "model_basename": "tmodel_",
         "preload": "latest",
+        "checkpoint_every_steps": 0,
+        "keep_last_checkpoints": 0,
+        "split_seed": 42,
         "tokenizer_file": "tokenizer_{0}.json",
-        "experiment_name": "runs/tmodel"
+        "token_cache": False,
+        "token_cache_folder": "token_cache",
+        "experiment_name": "runs/tmodel",
+        "metrics_sinks": ["tensorboard"],
+        "log_every_steps": 50
     }
 
-def get_weights_file_path(config, epoch: str):
+def get_weights_file_path(config, epoch: str, extension: str = '.pt'):
+    # .pt: full training checkpoint, .safetensors: model weights only, for inference (see weights_file.py)
     model_folder = f"{config['datasource']}_{config['model_folder']}"
-    model_filename = f"{config['model_basename']}{epoch}.pt"
+    model_filename = f"{config['model_basename']}{epoch}{extension}"
     return str(Path('.') / model_folder / model_filename)
 
-# Find the latest weights file in the weights folder
-def latest_weights_file_path(config):
+def get_quantized_weights_file_path(config, dtype: str):
+    # Kept out of the model_basename pattern, so it is never taken for a training checkpoint
+    model_folder = f"{config['datasource']}_{config['model_folder']}"
+    return str(Path('.') / model_folder / f"quantized_{dtype}.pt")
+
+# The weights files in the weights folder, from the oldest to the latest
+def weights_file_paths(config, extension: str = '.pt'):
     model_folder = f"{config['datasource']}_{config['model_folder']}"
-    model_filename = f"{config['model_basename']}*"
-    weights_files = list(Path(model_folder).glob(model_filename))
+    model_filename = f"{config['model_basename']}*{extension}"
+    # Order by the epoch number in the file name, not by the name: epoch 100 comes after epoch 99.
+    # Checkpoints saved during an epoch are named <epoch>-<step> and come before the one of the end of the epoch
+    weights_files = []
+    for path in Path(model_folder).glob(model_filename):
+        epoch, _, step = path.name[len(config['model_basename']):-len(extension)].partition('-')
+        if epoch.isdigit() and (step.isdigit() or not step):
+            weights_files.append(((int(epoch), int(step) if step else float('inf')), path))
+    return [str(path) for _, path in sorted(weights_files)]
+
+# Find the latest weights file in the weights folder
+def latest_weights_file_path(config, extension: str = '.pt'):
+    weights_files = weights_file_paths(config, extension)
     if len(weights_files) == 0:
         return None
-    weights_files.sort()
-    return str(weights_files[-1])
+    return weights_files[-1]
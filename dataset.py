@@ -1,12 +1,20 @@
+import itertools
+import os
+import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, Subset, get_worker_info
+from tokenizers import Tokenizer
 
 class BilingualDataset(Dataset):
 
-    def __init__(self, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, seq_len):
+    def __init__(self, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, seq_len, token_cache=None):
         super().__init__()
+        # The samples are only token ids, BilingualCollate adds the special tokens and the padding to the whole batch
         self.seq_len = seq_len
+        # Pre-tokenized ids of the whole dataset ds was split from, see token_cache.py
+        self.token_cache = token_cache
+        self.cache_indices = ds.indices if isinstance(ds, Subset) else range(len(ds))
 
         self.ds = ds
         self.tokenizer_src = tokenizer_src
@@ -14,77 +22,196 @@ class BilingualDataset(Dataset):
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
 
-        self.sos_token = torch.tensor([tokenizer_tgt.token_to_id("[SOS]")], dtype=torch.int64)
-        self.eos_token = torch.tensor([tokenizer_tgt.token_to_id("[EOS]")], dtype=torch.int64)
-        self.pad_token = torch.tensor([tokenizer_tgt.token_to_id("[PAD]")], dtype=torch.int64)
-
     def __len__(self):
         return len(self.ds)
 
+    def reload_tokenizers(self):
+        # Give the process its own copy of the tokenizers instead of the ones inherited from its parent
+        self.tokenizer_src = Tokenizer.from_str(self.tokenizer_src.to_str())
+        self.tokenizer_tgt = Tokenizer.from_str(self.tokenizer_tgt.to_str())
+
     def __getitem__(self, idx):
         src_target_pair = self.ds[idx]
         src_text = src_target_pair['translation'][self.src_lang]
         tgt_text = src_target_pair['translation'][self.tgt_lang]
 
-        # Transform the text into tokens
-        enc_input_tokens = self.tokenizer_src.encode(src_text).ids
-        dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
-
-        # Add sos, eos and padding to each sentence
-        enc_num_padding_tokens = self.seq_len - len(enc_input_tokens) - 2  # We will add <s> and </s>
-        # We will only add <s>, and </s> only on the label
-        dec_num_padding_tokens = self.seq_len - len(dec_input_tokens) - 1
+        # Transform the text into tokens, or read them from the cache when it was built
+        if self.token_cache is not None:
+            enc_input_tokens = self.token_cache.src(self.cache_indices[idx])
+            dec_input_tokens = self.token_cache.tgt(self.cache_indices[idx])
+        else:
+            enc_input_tokens = self.tokenizer_src.encode(src_text).ids
+            dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
 
-        # Make sure the number of padding tokens is not negative. If it is, the sentence is too long
-        if enc_num_padding_tokens < 0 or dec_num_padding_tokens < 0:
+        # Make sure the sentence fits in seq_len once <s> and </s> are added to the source, and one of them to the target
+        if len(enc_input_tokens) + 2 > self.seq_len or len(dec_input_tokens) + 1 > self.seq_len:
             raise ValueError("Sentence is too long")
 
-        # Add <s> and </s> token
-        encoder_input = torch.cat(
-            [
-                self.sos_token,
-                torch.tensor(enc_input_tokens, dtype=torch.int64),
-                self.eos_token,
-                torch.tensor([self.pad_token] * enc_num_padding_tokens, dtype=torch.int64),
-            ],
-            dim=0,
-        )
-
-        # Add only <s> token
-        decoder_input = torch.cat(
-            [
-                self.sos_token,
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
-                torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
-            ],
-            dim=0,
-        )
-
-        # Add only </s> token
-        label = torch.cat(
-            [
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
-                self.eos_token,
-                torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
-            ],
-            dim=0,
-        )
-
-        # Double check the size of the tensors to make sure they are all seq_len long
-        assert encoder_input.size(0) == self.seq_len
-        assert decoder_input.size(0) == self.seq_len
-        assert label.size(0) == self.seq_len
-
         return {
-            "encoder_input": encoder_input,  # (seq_len)
-            "decoder_input": decoder_input,  # (seq_len)
-            "encoder_mask": (encoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int(), # (1, 1, seq_len)
-            "decoder_mask": (decoder_input != self.pad_token).unsqueeze(0).int() & causal_mask(decoder_input.size(0)), # (1, seq_len) & (1, seq_len, seq_len),
-            "label": label,  # (seq_len)
+            "src_ids": enc_input_tokens,  # (src_len)
+            "tgt_ids": dec_input_tokens,  # (tgt_len)
             "src_text": src_text,
             "tgt_text": tgt_text,
         }
-    
-def causal_mask(size):
-    mask = torch.triu(torch.ones((1, size, size)), diagonal=1).type(torch.int)
-    return mask == 0
\ No newline at end of file
+
+def worker_init_fn(worker_id):
+    # HF tokenizers do not mix well with fork: disable their thread pool in the worker
+    # and re-create the tokenizers of the dataset
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    get_worker_info().dataset.reload_tokenizers()
+
+def dataloader_kwargs(config):
+    # DataLoader arguments for loading the batches in worker processes, ahead of the training step
+    if config['num_workers'] == 0:
+        return {'pin_memory': config['pin_memory']}
+    return {
+        'num_workers': config['num_workers'],
+        'persistent_workers': config['persistent_workers'],
+        'prefetch_factor': config['prefetch_factor'],
+        'pin_memory': config['pin_memory'],
+        'worker_init_fn': worker_init_fn,
+    }
+
+# Causal masks already built, by (device, dtype): each one is built for the largest size requested so far
+_causal_masks = {}
+
+def causal_mask(size, device=None, dtype=torch.bool):
+    # The mask is kept on the device, so callers only slice it instead of building and copying a new one.
+    # It is shared: it must not be modified in place
+    key = (torch.device(device if device is not None else 'cpu'), dtype)
+    mask = _causal_masks.get(key)
+    if mask is None or mask.size(-1) < size:
+        mask = torch.triu(torch.ones((1, size, size), device=key[0]), diagonal=1).type(torch.int)
+        mask = (mask == 0).to(dtype)
+        _causal_masks[key] = mask
+    return mask[:, :size, :size]
+
+class BilingualCollate:
+
+    def __init__(self, sos_token: int, eos_token: int, pad_token: int, seq_len: int=None):
+        # With seq_len every batch is padded to seq_len, otherwise to the longest sample of the batch
+        self.sos_token = sos_token
+        self.eos_token = eos_token
+        self.pad_token = pad_token
+        self.seq_len = seq_len
+
+    def __call__(self, batch):
+        batch_size = len(batch)
+        src_lengths = torch.tensor([len(item["src_ids"]) for item in batch]) # (B)
+        tgt_lengths = torch.tensor([len(item["tgt_ids"]) for item in batch]) # (B)
+        # <s> and </s> are added to the source, only <s> to the decoder input and only </s> to the label
+        src_len = self.seq_len or int(src_lengths.max()) + 2
+        tgt_len = self.seq_len or int(tgt_lengths.max()) + 1
+        # The token ids of the whole batch, back to back
+        src_ids = torch.from_numpy(np.concatenate([np.asarray(item["src_ids"], dtype=np.int64) for item in batch]))
+        tgt_ids = torch.from_numpy(np.concatenate([np.asarray(item["tgt_ids"], dtype=np.int64) for item in batch]))
+
+        # Each batch tensor is allocated once, padded, and the ids of all the rows are written with one masked assignment:
+        # the mask selects the positions of the ids in row-major order, which is the order of the concatenation
+        src_pos = torch.arange(src_len).unsqueeze(0) # (1, src_len)
+        tgt_pos = torch.arange(tgt_len).unsqueeze(0) # (1, tgt_len)
+        rows = torch.arange(batch_size)
+
+        encoder_input = torch.full((batch_size, src_len), self.pad_token, dtype=torch.int64)
+        encoder_input[(src_pos >= 1) & (src_pos <= src_lengths.unsqueeze(1))] = src_ids
+        encoder_input[:, 0] = self.sos_token
+        encoder_input[rows, src_lengths + 1] = self.eos_token
+
+        decoder_input = torch.full((batch_size, tgt_len), self.pad_token, dtype=torch.int64)
+        decoder_input[(tgt_pos >= 1) & (tgt_pos <= tgt_lengths.unsqueeze(1))] = tgt_ids
+        decoder_input[:, 0] = self.sos_token
+
+        label = torch.full((batch_size, tgt_len), self.pad_token, dtype=torch.int64)
+        label[tgt_pos < tgt_lengths.unsqueeze(1)] = tgt_ids
+        label[rows, tgt_lengths] = self.eos_token
+
+        return {
+            "encoder_input": encoder_input,  # (B, src_len)
+            "decoder_input": decoder_input,  # (B, tgt_len)
+            # Compact boolean padding masks. The causal part of the decoder mask is the same for every sample,
+            # it is combined on the device with the shared causal_mask
+            "encoder_mask": (src_pos < (src_lengths + 2).unsqueeze(1)).view(batch_size, 1, 1, src_len), # (B, 1, 1, src_len)
+            "decoder_mask": (tgt_pos < (tgt_lengths + 1).unsqueeze(1)).view(batch_size, 1, 1, tgt_len), # (B, 1, 1, tgt_len)
+            "label": label,  # (B, tgt_len)
+            "src_text": [item["src_text"] for item in batch],
+            "tgt_text": [item["tgt_text"] for item in batch],
+        }
+
+class LengthBucketBatchSampler(Sampler):
+
+    def __init__(self, lengths, max_tokens: int, shuffle: bool=True, pool_size: int=4096, num_replicas: int=1, rank: int=0, seed: int=None):
+        # lengths: padded length of each sample, max_tokens: budget of batch size * longest sample of the batch
+        # num_replicas, rank: in distributed training, each process only iterates over its share of the batches
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # Every process must build the same batches: they are shuffled with the seed and the epoch
+        self.seed = seed if seed is not None else int(torch.randint(2 ** 31, ()))
+        self.epoch = 0
+        # The batches of the next epoch, built in advance so that len() is known before iterating
+        self.batches = self._build_batches()
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.batches = self._build_batches()
+
+    def _build_batches(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.lengths), generator=generator).tolist() if self.shuffle else list(range(len(self.lengths)))
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            # Sort a pool of samples by length so that each batch groups samples of similar length
+            pool = sorted(order[start:start + self.pool_size], key=lambda idx: self.lengths[idx])
+            batch, batch_len = [], 0
+            for idx in pool:
+                new_len = max(batch_len, self.lengths[idx])
+                # Close the batch when one more sample would exceed the token budget
+                if batch and new_len * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch, new_len = [], self.lengths[idx]
+                batch.append(idx)
+                batch_len = new_len
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        # Every process gets the same number of batches, so that they all run the same number of steps
+        num_batches = len(batches) // self.num_replicas
+        return batches[self.rank:num_batches * self.num_replicas:self.num_replicas]
+
+    def __iter__(self):
+        batches = self.batches
+        self.set_epoch(self.epoch + 1)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+class ResumableBatchSampler(Sampler):
+
+    def __init__(self, batch_sampler):
+        # Wraps a batch sampler whose order only depends on the epoch (set_epoch), so that a run resumed during
+        # an epoch can start after the batches it had already trained without loading them
+        self.batch_sampler = batch_sampler
+        self.skip = 0
+
+    def set_epoch(self, epoch: int):
+        # The epoch goes to the batch sampler, or to the sampler of a BatchSampler
+        for sampler in (self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
+    def skip_batches(self, count: int):
+        # The next iteration starts after its first count batches
+        self.skip = count
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        return itertools.islice(iter(self.batch_sampler), skip, None)
+
+    def __len__(self):
+        return len(self.batch_sampler)
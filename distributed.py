@@ -0,0 +1,48 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+# Data-parallel training launched with torchrun, e.g. on a CPU-only host:
+#   torchrun --standalone --nproc_per_node 4 train.py
+# Every process trains a replica of the model on its own share of the batches and the gradients are averaged
+# across the processes. Without torchrun there is one process and nothing here has any effect
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process() -> bool:
+    # Only the first process writes the checkpoints, runs the validation and logs
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def init_distributed(config):
+    # Returns the device of this process
+    if 'RANK' not in os.environ:
+        return None
+    backend = config['dist_backend']
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if backend == 'nccl':
+        device = torch.device(f'cuda:{local_rank}')
+        torch.cuda.set_device(device)
+    else:
+        # gloo: one CPU process per replica
+        device = torch.device('cpu')
+        # torchrun defaults to one thread per process, share the cores of the host between its processes instead
+        threads = config['threads_per_process'] or max(1, os.cpu_count() // int(os.environ['LOCAL_WORLD_SIZE']))
+        torch.set_num_threads(threads)
+    dist.init_process_group(backend)
+    return device
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,225 @@
+import hashlib
+import inspect
+import os
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model import MultiHeadAttentionBlock
+
+# Inference graphs with tensor-only, fixed signatures, which can be traced, compiled or exported:
+# EncoderExport runs the encoder and projects the cross-attention keys and values of every decoder layer once,
+# DecoderStep runs one decoding step on a preallocated key/value cache, DecoderStepWithPast on a growing one.
+# They compute the same as Transformer.encode / decode / project with the cache of init_cache
+
+def merge_heads(x):
+    # (batch, h, seq_len, d_k) --> (batch, seq_len, h * d_k)
+    return x.transpose(1, 2).reshape(x.shape[0], x.shape[2], x.shape[1] * x.shape[3])
+
+class EncoderExport(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, src, src_mask):
+        # src: (batch, src_len), src_mask: (batch, 1, 1, src_len) bool
+        encoder_output = self.model.encode(src, src_mask) # (batch, src_len, d_model)
+        cross_keys, cross_values = [], []
+        for layer in self.model.decoder.layers:
+            attention = layer.cross_attention_block
+            key, value = (attention.split_heads(x) for x in attention.w_kv(encoder_output).chunk(2, dim=-1))
+            cross_keys.append(key)
+            cross_values.append(value)
+        # (num_layers, batch, h, src_len, d_k)
+        return torch.stack(cross_keys), torch.stack(cross_values)
+
+class DecoderStep(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, token, position, src_mask, cross_keys, cross_values, self_keys, self_values):
+        # token: (batch, 1) newest token, position: (1) its position, src_mask: (batch, 1, 1, src_len) bool
+        # cross_keys, cross_values: (num_layers, batch, h, src_len, d_k) from EncoderExport
+        # self_keys, self_values: (num_layers, batch, h, cache_len, d_k), the keys and values of the positions
+        # before `position`; the ones of the new token are written in place at `position`
+        x = self.model.tgt_embed(token) + self.model.tgt_pos.pe.index_select(1, position) # (batch, 1, d_model)
+        cache_len = self_keys.shape[3]
+        # The new token attends to its position and the ones before it, the rest of the cache is not filled yet
+        self_mask = (torch.arange(cache_len, device=token.device) <= position).view(1, 1, 1, cache_len)
+        for i, layer in enumerate(self.model.decoder.layers):
+            residual = layer.residual_connections
+
+            attention = layer.self_attention_block
+            y = residual[0].norm(x)
+            query, key, value = (attention.split_heads(t) for t in attention.w_qkv(y).chunk(3, dim=-1))
+            self_keys[i].index_copy_(2, position, key)
+            self_values[i].index_copy_(2, position, value)
+            y = F.scaled_dot_product_attention(query, self_keys[i], self_values[i], attn_mask=self_mask)
+            x = residual[0].residual(x, attention.w_o(merge_heads(y)))
+
+            attention = layer.cross_attention_block
+            y = residual[1].norm(x)
+            query = attention.split_heads(attention.w_q(y))
+            y = F.scaled_dot_product_attention(query, cross_keys[i], cross_values[i], attn_mask=src_mask)
+            x = residual[1].residual(x, attention.w_o(merge_heads(y)))
+
+            y = residual[2].norm(x)
+            x = residual[2].residual(x, layer.feed_forward_block(y))
+        x = self.model.decoder.norm(x)
+        # (batch, vocab_size)
+        return self.model.project(x[:, -1]), self_keys, self_values
+
+class DecoderStepWithPast(nn.Module):
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, token, src_mask, cross_keys, cross_values, past_keys, past_values):
+        # Same step as DecoderStep with a growing cache instead of a preallocated one, for the exporters that
+        # want dynamic shapes (ONNX): the keys and values of the new token are appended to the past ones.
+        # The attention is computed with the explicit formula: torch.onnx only exports scaled_dot_product_attention
+        # from torch 2.1.
+        # token: (batch, 1), src_mask: (batch, 1, 1, src_len) bool
+        # cross_keys, cross_values: (num_layers, batch, h, src_len, d_k) from EncoderExport
+        # past_keys, past_values: (num_layers, batch, h, past_len, d_k), empty at the first step
+        past_len = past_keys.shape[3]
+        x = self.model.tgt_embed(token) + self.model.tgt_pos.pe[:, past_len:past_len + 1] # (batch, 1, d_model)
+        present_keys, present_values = [], []
+        for i, layer in enumerate(self.model.decoder.layers):
+            residual = layer.residual_connections
+
+            attention = layer.self_attention_block
+            y = residual[0].norm(x)
+            query, key, value = (attention.split_heads(t) for t in attention.w_qkv(y).chunk(3, dim=-1))
+            # (batch, h, past_len + 1, d_k): the new token attends to every position before it, no mask is needed
+            key = torch.cat([past_keys[i], key], dim=2)
+            value = torch.cat([past_values[i], value], dim=2)
+            present_keys.append(key)
+            present_values.append(value)
+            y, _ = MultiHeadAttentionBlock.attention(query, key, value, None, None)
+            x = residual[0].residual(x, attention.w_o(merge_heads(y)))
+
+            attention = layer.cross_attention_block
+            y = residual[1].norm(x)
+            query = attention.split_heads(attention.w_q(y))
+            y, _ = MultiHeadAttentionBlock.attention(query, cross_keys[i], cross_values[i], src_mask, None)
+            x = residual[1].residual(x, attention.w_o(merge_heads(y)))
+
+            y = residual[2].norm(x)
+            x = residual[2].residual(x, layer.feed_forward_block(y))
+        x = self.model.decoder.norm(x)
+        # (batch, vocab_size), (num_layers, batch, h, past_len + 1, d_k)
+        return self.model.project(x[:, -1]), torch.stack(present_keys), torch.stack(present_values)
+
+def bucket_size(length: int, bucket: int, max_len: int) -> int:
+    # Round up to a multiple of bucket: every length of a bucket runs the same graph
+    return min(-(-length // bucket) * bucket, max_len)
+
+def source_hash() -> str:
+    # The graphs are built from the code of model.py and of this file: a change to either one invalidates the saved ones
+    digest = hashlib.sha256()
+    for path in (inspect.getfile(MultiHeadAttentionBlock), __file__):
+        digest.update(Path(path).read_bytes())
+    return digest.hexdigest()[:16]
+
+class StepRunner:
+
+    def __init__(self, model, backend: str='eager', cache_dir=None, model_id: str='', bucket: int=32, max_len: int=350):
+        # backend: 'eager' runs the export modules as they are, 'trace' runs them traced with TorchScript
+        # and frozen, 'compile' with torch.compile.
+        # The graphs are specialized on the shapes: the source length is padded to a multiple of bucket and the
+        # self-attention cache grows by doubling, so only a few shapes, hence graphs, are ever seen.
+        # cache_dir keeps the traced graphs (and the torch.compile artifacts) on disk for the next processes,
+        # model_id identifies the weights and the backends of the model they were built with
+        self.model = model.eval()
+        self.backend = backend
+        self.bucket = bucket
+        self.max_len = max_len
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.model_id = hashlib.sha256(f'{model_id}|{torch.__version__}|{source_hash()}'.encode()).hexdigest()[:16]
+        attention = model.decoder.layers[0].self_attention_block
+        self.num_layers = len(model.decoder.layers)
+        self.h = attention.h
+        self.d_k = attention.d_k
+        # DecoderStep reads the positional encodings from the table: it must cover every position
+        model.tgt_pos.ensure_length(max_len)
+
+        self.encoder = EncoderExport(model).eval()
+        self.step = DecoderStep(model).eval()
+        self.graphs = {}
+        if backend == 'compile':
+            if self.cache_dir is not None:
+                # Set before the first compilation: inductor reads it when it starts
+                os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(self.cache_dir / 'inductor'))
+            # dynamic=False: one graph per shape, the buckets bound the number of shapes
+            self.encoder = torch.compile(self.encoder, dynamic=False)
+            self.step = torch.compile(self.step, dynamic=False)
+        elif backend != 'trace':
+            assert backend == 'eager', f"Unknown backend {backend}"
+
+    def _traced(self, name, module, inputs):
+        # One traced graph per module and input shapes, loaded from cache_dir when it was traced before
+        key = (name,) + tuple(tuple(t.shape) for t in inputs)
+        graph = self.graphs.get(key)
+        if graph is not None:
+            return graph
+        path = None
+        if self.cache_dir is not None:
+            shapes = '_'.join('x'.join(map(str, shape)) for shape in key[1:])
+            path = self.cache_dir / f"{name}_{self.model_id}_{shapes}.pt"
+        if path is not None and path.exists():
+            graph = torch.jit.load(str(path), map_location=inputs[0].device)
+        else:
+            with torch.no_grad():
+                # The step writes into the cache tensors: trace on copies
+                graph = torch.jit.freeze(torch.jit.trace(module, tuple(t.clone() for t in inputs), check_trace=False))
+            if path is not None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                torch.jit.save(graph, str(path))
+        self.graphs[key] = graph
+        return graph
+
+    def run_encoder(self, src, src_mask):
+        if self.backend == 'trace':
+            return self._traced('encoder', self.encoder, (src, src_mask))(src, src_mask)
+        return self.encoder(src, src_mask)
+
+    def run_step(self, *inputs):
+        if self.backend == 'trace':
+            return self._traced('step', self.step, inputs)(*inputs)
+        return self.step(*inputs)
+
+    @torch.no_grad()
+    def generate(self, source, source_mask, sos_idx: int, pad_idx: int):
+        # source: (batch, src_len), source_mask: (batch, 1, 1, src_len). Yields the next token of every row, (batch)
+        batch_size, src_len = source.shape
+        device = source.device
+        # Pad the source to its bucket, the padding is masked
+        padded_len = bucket_size(src_len, self.bucket, max(self.max_len, src_len))
+        src = torch.full((batch_size, padded_len), pad_idx, dtype=source.dtype, device=device)
+        src[:, :src_len] = source
+        src_mask = torch.zeros(batch_size, 1, 1, padded_len, dtype=torch.bool, device=device)
+        src_mask[..., :src_len] = source_mask.view(batch_size, 1, 1, src_len) != 0
+
+        cross_keys, cross_values = self.run_encoder(src, src_mask)
+        cache_len = min(self.bucket, self.max_len)
+        self_keys = torch.zeros(self.num_layers, batch_size, self.h, cache_len, self.d_k, dtype=cross_keys.dtype, device=device)
+        self_values = torch.zeros_like(self_keys)
+        token = torch.full((batch_size, 1), sos_idx, dtype=torch.int64, device=device)
+        for position in range(self.max_len - 1):
+            if position == cache_len:
+                # The cache is full: double it
+                new_len = min(2 * cache_len, self.max_len)
+                self_keys = F.pad(self_keys, (0, 0, 0, new_len - cache_len))
+                self_values = F.pad(self_values, (0, 0, 0, new_len - cache_len))
+                cache_len = new_len
+            logits, self_keys, self_values = self.run_step(token, torch.tensor([position], device=device), src_mask, cross_keys, cross_values, self_keys, self_values)
+            next_word = logits.argmax(dim=-1) # (batch)
+            yield next_word
+            token = next_word.unsqueeze(1)
@@ -0,0 +1,47 @@
+import torch
+
+# Greedy decoding, shared by the training validation, translate.py, quantize.py and the inference graphs of
+# export.py and onnx_export.py: every decoder yields the next token of each row, collect_greedy turns the
+# steps into translations
+
+@torch.no_grad()
+def greedy_steps(model, source, source_mask, sos_idx: int, max_len: int, shortlist=None):
+    # source: (batch, seq_len), source_mask: (batch, 1, 1, seq_len). Yields the next token of every row, (batch)
+    # Precompute the encoder output and reuse it for every step
+    encoder_output = model.encode(source, source_mask) # (batch, seq_len, d_model)
+    # Keys and values of the previous steps are cached, so each step only runs the newest token
+    cache = model.init_cache()
+    # With a shortlist (see shortlist.py) only the target tokens likely for these sources are projected
+    project = shortlist.projection(model, source) if shortlist is not None else model.project
+    next_word = torch.full((source.size(0), 1), sos_idx, dtype=torch.int64, device=source.device) # (batch, 1)
+    for _ in range(max_len - 1):
+        # calculate output for the last token, it may attend to every cached position so no causal mask is needed
+        out = model.decode(encoder_output, source_mask, next_word, None, cache)
+        next_word = project(out[:, -1]).argmax(dim=1, keepdim=True) # (batch, 1)
+        yield next_word.squeeze(1)
+
+def collect_greedy(steps, batch_size: int, sos_idx: int, eos_idx: int, pad_idx: int, device=None):
+    # steps: the next tokens of every row, (batch), as tensors or numpy arrays.
+    # Returns (batch, len) starting with sos, padded after the eos token of each row. Stops once every row is finished
+    decoder_input = torch.full((batch_size, 1), sos_idx, dtype=torch.int64, device=device)
+    # Rows that already predicted the eos token, they only get padding
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    for next_word in steps:
+        next_word = torch.as_tensor(next_word, device=device).to(torch.int64).masked_fill(finished, pad_idx) # (batch)
+        decoder_input = torch.cat([decoder_input, next_word.unsqueeze(1)], dim=1)
+        finished |= next_word == eos_idx
+        if finished.all():
+            break
+    return decoder_input
+
+def batch_greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, shortlist=None):
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    steps = greedy_steps(model, source, source_mask, sos_idx, max_len, shortlist)
+    # (batch, len), padded after the eos token
+    return collect_greedy(steps, source.size(0), sos_idx, eos_idx, pad_idx, source.device)
+
+def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device):
+    # Decode a single sentence
+    return batch_greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device).squeeze(0)
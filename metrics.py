@@ -0,0 +1,140 @@
+import queue
+import threading
+import time
+
+import torch
+
+# Training telemetry. The loss is accumulated on the device and only read every log_every steps, so the
+# training loop does not wait for the device at every step. The scalars are written to the sinks
+# (TensorBoard, W&B) by a background thread
+
+class TensorBoardSink:
+
+    def __init__(self, log_dir: str):
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir)
+
+    def write(self, scalars: dict, step: int):
+        for name, value in scalars.items():
+            self.writer.add_scalar(name, value, step)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+class WandbSink:
+
+    def __init__(self):
+        # wandb.init is called by the script, with its project and config
+        import wandb
+        self.wandb = wandb
+        # define our custom x axis metric
+        wandb.define_metric("global_step")
+        # define which metrics will be plotted against it
+        wandb.define_metric("validation/*", step_metric="global_step")
+        wandb.define_metric("train/*", step_metric="global_step")
+
+    def write(self, scalars: dict, step: int):
+        self.wandb.log({**scalars, 'global_step': step})
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def make_sinks(config):
+    sinks = {
+        'tensorboard': lambda: TensorBoardSink(config['experiment_name']),
+        'wandb': WandbSink,
+    }
+    return [sinks[name]() for name in config['metrics_sinks']]
+
+class MetricsLogger:
+
+    def __init__(self, sinks, log_every: int=50):
+        self.sinks = sinks
+        self.log_every = log_every
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+        self.start_epoch()
+
+    def start_epoch(self):
+        self.epoch_data_time = 0.0
+        self.epoch_compute_time = 0.0
+        self._start_window()
+
+    def _start_window(self):
+        self.loss_sum = None
+        self.steps = 0
+        self.tokens = 0
+        self.samples = 0
+        self.data_time = 0.0
+        self.window_start = time.perf_counter()
+
+    def add_data_time(self, seconds: float):
+        # Time spent waiting for the next batch
+        self.data_time += seconds
+
+    def log_step(self, loss: torch.Tensor, num_tokens: int, num_samples: int, step: int):
+        # Accumulate without reading the loss: no synchronization with the device.
+        # Returns the scalars when they were written, None otherwise
+        loss = loss.detach().float()
+        self.loss_sum = loss if self.loss_sum is None else self.loss_sum + loss
+        self.steps += 1
+        self.tokens += num_tokens
+        self.samples += num_samples
+        if self.steps < self.log_every:
+            return None
+        return self.flush(step)
+
+    def flush(self, step: int):
+        # Read the accumulated loss, which waits for the device, and write the averages of the window
+        if self.steps == 0:
+            return None
+        loss = self.loss_sum.item() / self.steps
+        # The device has caught up with the host: the rest of the window was spent computing
+        elapsed = time.perf_counter() - self.window_start
+        compute_time = max(elapsed - self.data_time, 0.0)
+        self.epoch_data_time += self.data_time
+        self.epoch_compute_time += compute_time
+        scalars = {
+            'train/loss': loss,
+            'train/tokens_per_sec': self.tokens / elapsed,
+            'train/samples_per_sec': self.samples / elapsed,
+            'train/data_wait_fraction': self.data_time / max(elapsed, 1e-9),
+        }
+        self.log(scalars, step)
+        self._start_window()
+        return scalars
+
+    def end_epoch(self, step: int):
+        # Returns the time spent waiting for data and computing during the epoch
+        self.flush(step)
+        return self.epoch_data_time, self.epoch_compute_time
+
+    def log(self, scalars: dict, step: int):
+        # Python numbers or tensors already read by the caller
+        self.queue.put((scalars, step))
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+        for sink in self.sinks:
+            sink.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            scalars, step = item
+            for sink in self.sinks:
+                sink.write({name: float(value) for name, value in scalars.items()}, step)
+            # Flush once the pending scalars are written, not after each of them
+            if self.queue.empty():
+                for sink in self.sinks:
+                    sink.flush()
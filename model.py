@@ -1,23 +1,41 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import math
 
 class LayerNormalization(nn.Module):
 
-    def __init__(self, features: int, eps:float=10**-6) -> None:
+    def __init__(self, features: int, eps:float=10**-6, backend: str='explicit') -> None:
         super().__init__()
         self.eps = eps
         self.alpha = nn.Parameter(torch.ones(features)) # alpha is a learnable parameter
         self.bias = nn.Parameter(torch.zeros(features)) # bias is a learnable parameter
+        # 'explicit' computes the statistics and the normalization op by op, 'fused' runs the single F.layer_norm kernel
+        self.backend = backend
 
     def forward(self, x):
         # x: (batch, seq_len, hidden_size)
+        # Under mixed precision x may be bf16/fp16: compute the statistics in fp32 and cast the result back
+        dtype = x.dtype
+        x = x.float()
+        if self.backend == 'fused':
+            return self.fused_forward(x).to(dtype)
          # Keep the dimension for broadcasting
         mean = x.mean(dim = -1, keepdim = True) # (batch, seq_len, 1)
         # Keep the dimension for broadcasting
         std = x.std(dim = -1, keepdim = True) # (batch, seq_len, 1)
         # eps is to prevent dividing by zero or when std is very small
-        return self.alpha * (x - mean) / (std + self.eps) + self.bias
+        return (self.alpha * (x - mean) / (std + self.eps) + self.bias).to(dtype)
+
+    def fused_forward(self, x):
+        # F.layer_norm divides by the biased std, sqrt(var + eps), where forward divides by the unbiased one plus eps:
+        # std = sqrt(var * n / (n - 1)). Scaling alpha by sqrt((n - 1) / n) and eps alike gives the same result with
+        # the same parameters, so existing checkpoints load unchanged. The only difference is sqrt(std^2 + eps^2)
+        # in place of std + eps: a relative difference of about eps / std, 1e-6 for activations of unit std
+        n = x.shape[-1]
+        scale = math.sqrt((n - 1) / n)
+        return F.layer_norm(x, (n,), self.alpha * scale, self.bias, (self.eps * scale) ** 2)
 
 class FeedForwardBlock(nn.Module):
 
@@ -51,23 +69,40 @@ class PositionalEncoding(nn.Module):
         self.d_model = d_model
         self.seq_len = seq_len
         self.dropout = nn.Dropout(dropout)
+        # Register the positional encoding as a buffer. It is not saved with the weights since it only depends on d_model,
+        # which also lets it grow past seq_len
+        self.register_buffer('pe', PositionalEncoding.build_table(seq_len, d_model), persistent=False)
+
+    @staticmethod
+    def build_table(seq_len: int, d_model: int, device=None):
         # Create a matrix of shape (seq_len, d_model)
-        pe = torch.zeros(seq_len, d_model)
+        pe = torch.zeros(seq_len, d_model, device=device)
         # Create a vector of shape (seq_len)
-        position = torch.arange(0, seq_len, dtype=torch.float).unsqueeze(1) # (seq_len, 1)
+        position = torch.arange(0, seq_len, dtype=torch.float, device=device).unsqueeze(1) # (seq_len, 1)
         # Create a vector of shape (d_model)
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * (-math.log(10000.0) / d_model)) # (d_model / 2)
+        div_term = torch.exp(torch.arange(0, d_model, 2, device=device).float() * (-math.log(10000.0) / d_model)) # (d_model / 2)
         # Apply sine to even indices
         pe[:, 0::2] = torch.sin(position * div_term) # sin(position * (10000 ** (2i / d_model))
         # Apply cosine to odd indices
         pe[:, 1::2] = torch.cos(position * div_term) # cos(position * (10000 ** (2i / d_model))
         # Add a batch dimension to the positional encoding
-        pe = pe.unsqueeze(0) # (1, seq_len, d_model)
-        # Register the positional encoding as a buffer
-        self.register_buffer('pe', pe)
-
-    def forward(self, x):
-        x = x + (self.pe[:, :x.shape[1], :]).requires_grad_(False) # (batch, seq_len, d_model)
+        return pe.unsqueeze(0) # (1, seq_len, d_model)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # Older checkpoints saved the table, it is recomputed instead
+        state_dict.pop(f'{prefix}pe', None)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def ensure_length(self, length: int):
+        if length > self.pe.size(1):
+            # Extend the table on its device instead of failing past seq_len, doubling it to limit the reallocations
+            self.pe = PositionalEncoding.build_table(max(length, 2 * self.pe.size(1)), self.d_model, self.pe.device)
+
+    def forward(self, x, start_pos: int = 0):
+        # start_pos is the position of the first token of x, it is non zero when decoding incrementally
+        end_pos = start_pos + x.shape[1]
+        self.ensure_length(end_pos)
+        x = x + (self.pe[:, start_pos:end_pos, :]).requires_grad_(False) # (batch, seq_len, d_model)
         return self.dropout(x)
 
 class ResidualConnection(nn.Module):
@@ -78,21 +113,38 @@ class ResidualConnection(nn.Module):
             self.norm = LayerNormalization(features)
     
         def forward(self, x, sublayer):
-            return x + self.dropout(sublayer(self.norm(x)))
+            return self.residual(x, sublayer(self.norm(x)))
+
+        def residual(self, x, sublayer_output):
+            # The blocks call norm and residual around their sublayers themselves, instead of passing
+            # closures to forward, so that the graph can be traced and compiled
+            return x + self.dropout(sublayer_output)
 
 class MultiHeadAttentionBlock(nn.Module):
 
-    def __init__(self, d_model: int, h: int, dropout: float) -> None:
+    def __init__(self, d_model: int, h: int, dropout: float, backend: str = 'explicit', cross_attention: bool = False) -> None:
         super().__init__()
         self.d_model = d_model # Embedding vector size
         self.h = h # Number of heads
         # Make sure d_model is divisible by h
         assert d_model % h == 0, "d_model is not divisible by h"
+        # 'explicit' computes the attention with the formula from the paper, 'sdpa' with the fused
+        # F.scaled_dot_product_attention kernel which does not materialize the attention scores
+        assert backend in ('explicit', 'sdpa'), f"Unknown attention backend {backend}"
+        self.backend = backend
+        # Keep the attention scores of the last call for visualization, this forces the explicit path
+        self.capture_scores = False
+        self.attention_scores = None
 
         self.d_k = d_model // h # Dimension of vector seen by each head
-        self.w_q = nn.Linear(d_model, d_model, bias=False) # Wq
-        self.w_k = nn.Linear(d_model, d_model, bias=False) # Wk
-        self.w_v = nn.Linear(d_model, d_model, bias=False) # Wv
+        # The projections are packed so that a single GEMM computes them:
+        # self-attention projects q, k and v from the same input, cross-attention projects k and v from the encoder output
+        self.cross_attention = cross_attention
+        if cross_attention:
+            self.w_q = nn.Linear(d_model, d_model, bias=False) # Wq
+            self.w_kv = nn.Linear(d_model, 2 * d_model, bias=False) # [Wk; Wv]
+        else:
+            self.w_qkv = nn.Linear(d_model, 3 * d_model, bias=False) # [Wq; Wk; Wv]
         self.w_o = nn.Linear(d_model, d_model, bias=False) # Wo
         self.dropout = nn.Dropout(dropout)
 
@@ -103,8 +155,9 @@ class MultiHeadAttentionBlock(nn.Module):
         # (batch, h, seq_len, d_k) --> (batch, h, seq_len, seq_len)
         attention_scores = (query @ key.transpose(-2, -1)) / math.sqrt(d_k)
         if mask is not None:
-            # Write a very low value (indicating -inf) to the positions where mask == 0
-            attention_scores.masked_fill_(mask == 0, -1e9)
+            # Write a very low value (indicating -inf) to the positions where mask == 0.
+            # -1e9 overflows fp16, take the lowest value of the dtype of the scores
+            attention_scores.masked_fill_(mask == 0, torch.finfo(attention_scores.dtype).min)
         attention_scores = attention_scores.softmax(dim=-1) # (batch, h, seq_len, seq_len) # Apply softmax
         if dropout is not None:
             attention_scores = dropout(attention_scores)
@@ -112,18 +165,68 @@ class MultiHeadAttentionBlock(nn.Module):
         # return attention scores which can be used for visualization
         return (attention_scores @ value), attention_scores
 
-    def forward(self, q, k, v, mask):
-        query = self.w_q(q) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-        key = self.w_k(k) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-        value = self.w_v(v) # (batch, seq_len, d_model) --> (batch, seq_len, d_model)
-
+    @staticmethod
+    def fused_attention(query, key, value, mask, dropout_p: float):
+        # The fused kernel expects a boolean mask which is True for the positions that can be attended,
+        # padding masks (int) and causal masks (bool) are both converted
+        attn_mask = None if mask is None else mask != 0
+        # (batch, h, seq_len, d_k) --> (batch, h, seq_len, d_k)
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=attn_mask, dropout_p=dropout_p)
+
+    def packed_projections(self):
+        # (name of the packed linear, names of the separate projections it replaces, in order)
+        if self.cross_attention:
+            return 'w_kv', ('w_k', 'w_v')
+        return 'w_qkv', ('w_q', 'w_k', 'w_v')
+
+    def reset_packed_parameters(self):
+        # Initialize each packed matrix like the separate d_model x d_model matrix it replaces
+        packed_name, names = self.packed_projections()
+        for weight in getattr(self, packed_name).weight.data.chunk(len(names), dim=0):
+            nn.init.xavier_uniform_(weight)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        # Checkpoints saved before the projections were packed have separate w_q, w_k and w_v weights:
+        # stack them into the packed weight, (d_model, d_model) * n --> (n * d_model, d_model)
+        packed_name, names = self.packed_projections()
+        if all(f'{prefix}{name}.weight' in state_dict for name in names):
+            state_dict[f'{prefix}{packed_name}.weight'] = torch.cat([state_dict.pop(f'{prefix}{name}.weight') for name in names], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+
+    def split_heads(self, x):
         # (batch, seq_len, d_model) --> (batch, seq_len, h, d_k) --> (batch, h, seq_len, d_k)
-        query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
-        key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
-        value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+        return x.view(x.shape[0], x.shape[1], self.h, self.d_k).transpose(1, 2)
+
+    def forward(self, q, k, v, mask, cache: dict = None, static_kv: bool = False):
+        # Self-attention blocks project q, k and v all from q: k and v must be the same tensor as q.
+        # cache holds the keys and values of the previous calls when decoding incrementally.
+        # static_kv means k and v do not change between calls (cross-attention on the encoder output),
+        # so they are projected only once, otherwise the new positions are appended to the cached ones.
+        reuse_kv = cache is not None and static_kv and 'key' in cache
+        if self.cross_attention:
+            query = self.split_heads(self.w_q(q)) # (batch, seq_len, d_model) --> (batch, h, seq_len, d_k)
+            if reuse_kv:
+                key, value = cache['key'], cache['value']
+            else:
+                # (batch, seq_len, 2 * d_model) --> 2 * (batch, h, seq_len, d_k)
+                key, value = (self.split_heads(x) for x in self.w_kv(k).chunk(2, dim=-1))
+        else:
+            # (batch, seq_len, 3 * d_model) --> 3 * (batch, h, seq_len, d_k)
+            query, key, value = (self.split_heads(x) for x in self.w_qkv(q).chunk(3, dim=-1))
+        if cache is not None and not reuse_kv:
+            if 'key' in cache:
+                # (batch, h, cached_len, d_k) --> (batch, h, cached_len + seq_len, d_k)
+                key = torch.cat([cache['key'], key], dim=2)
+                value = torch.cat([cache['value'], value], dim=2)
+            cache['key'], cache['value'] = key, value
 
         # Calculate attention
-        x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        if self.backend == 'sdpa' and not self.capture_scores:
+            x = MultiHeadAttentionBlock.fused_attention(query, key, value, mask, self.dropout.p if self.training else 0.0)
+        else:
+            x, attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+            if self.capture_scores:
+                self.attention_scores = attention_scores
         
         # Combine all the heads together
         # (batch, h, seq_len, d_k) --> (batch, seq_len, h, d_k) --> (batch, seq_len, d_model)
@@ -142,20 +245,27 @@ class EncoderBlock(nn.Module):
         self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(2)])
 
     def forward(self, x, src_mask):
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, src_mask))
-        x = self.residual_connections[1](x, self.feed_forward_block)
+        y = self.residual_connections[0].norm(x)
+        x = self.residual_connections[0].residual(x, self.self_attention_block(y, y, y, src_mask))
+        y = self.residual_connections[1].norm(x)
+        x = self.residual_connections[1].residual(x, self.feed_forward_block(y))
         return x
     
 class Encoder(nn.Module):
 
-    def __init__(self, features: int, layers: nn.ModuleList) -> None:
+    def __init__(self, features: int, layers: nn.ModuleList, activation_checkpointing: bool = False) -> None:
         super().__init__()
         self.layers = layers
         self.norm = LayerNormalization(features)
+        # Recompute the activations of each block during backward instead of keeping them alive
+        self.activation_checkpointing = activation_checkpointing
 
     def forward(self, x, mask):
         for layer in self.layers:
-            x = layer(x, mask)
+            if self.activation_checkpointing and self.training:
+                x = checkpoint(layer, x, mask, use_reentrant=False)
+            else:
+                x = layer(x, mask)
         return self.norm(x)
 
 class DecoderBlock(nn.Module):
@@ -167,22 +277,32 @@ class DecoderBlock(nn.Module):
         self.feed_forward_block = feed_forward_block
         self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(3)])
 
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask))
-        x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask))
-        x = self.residual_connections[2](x, self.feed_forward_block)
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache: dict = None):
+        self_cache = cache['self_attn'] if cache is not None else None
+        cross_cache = cache['cross_attn'] if cache is not None else None
+        y = self.residual_connections[0].norm(x)
+        x = self.residual_connections[0].residual(x, self.self_attention_block(y, y, y, tgt_mask, self_cache))
+        y = self.residual_connections[1].norm(x)
+        x = self.residual_connections[1].residual(x, self.cross_attention_block(y, encoder_output, encoder_output, src_mask, cross_cache, static_kv=True))
+        y = self.residual_connections[2].norm(x)
+        x = self.residual_connections[2].residual(x, self.feed_forward_block(y))
         return x
     
 class Decoder(nn.Module):
 
-    def __init__(self, features: int, layers: nn.ModuleList) -> None:
+    def __init__(self, features: int, layers: nn.ModuleList, activation_checkpointing: bool = False) -> None:
         super().__init__()
         self.layers = layers
         self.norm = LayerNormalization(features)
-
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, encoder_output, src_mask, tgt_mask)
+        # Recompute the activations of each block during backward instead of keeping them alive
+        self.activation_checkpointing = activation_checkpointing
+
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache: list = None):
+        for i, layer in enumerate(self.layers):
+            if self.activation_checkpointing and self.training and cache is None:
+                x = checkpoint(layer, x, encoder_output, src_mask, tgt_mask, use_reentrant=False)
+            else:
+                x = layer(x, encoder_output, src_mask, tgt_mask, cache[i] if cache is not None else None)
         return self.norm(x)
 
 class ProjectionLayer(nn.Module):
@@ -213,17 +333,56 @@ class Transformer(nn.Module):
         src = self.src_pos(src)
         return self.encoder(src, src_mask)
     
-    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor):
+    def decode(self, encoder_output: torch.Tensor, src_mask: torch.Tensor, tgt: torch.Tensor, tgt_mask: torch.Tensor, cache: list = None):
+        # When a cache from init_cache is given, tgt only contains the new tokens: the previous ones
+        # are already stored as keys and values in the cache
         # (batch, seq_len, d_model)
         tgt = self.tgt_embed(tgt)
-        tgt = self.tgt_pos(tgt)
-        return self.decoder(tgt, encoder_output, src_mask, tgt_mask)
+        tgt = self.tgt_pos(tgt, self.cache_length(cache))
+        return self.decoder(tgt, encoder_output, src_mask, tgt_mask, cache)
+
+    def init_cache(self):
+        # One cache per decoder layer, filled by the attention blocks during decode
+        return [{'self_attn': {}, 'cross_attn': {}} for _ in self.decoder.layers]
+
+    @staticmethod
+    def cache_length(cache):
+        # Number of target positions already stored in the cache
+        if cache is None or 'key' not in cache[0]['self_attn']:
+            return 0
+        return cache[0]['self_attn']['key'].size(2)
+
+    @staticmethod
+    def reorder_cache(cache, index: torch.Tensor, static_kv: bool = False):
+        # Select (and possibly repeat) the batch entries of the cache, e.g. to follow the beams kept by beam search.
+        # The cross-attention keys and values only depend on the source: they are the same for every beam of
+        # a sentence, so they are left as they are unless static_kv asks to reorder them too (e.g. when
+        # index moves entries between sentences)
+        for layer_cache in cache:
+            attn_caches = layer_cache.values() if static_kv else (layer_cache['self_attn'],)
+            for attn_cache in attn_caches:
+                for name, tensor in attn_cache.items():
+                    attn_cache[name] = tensor.index_select(0, index)
     
     def project(self, x):
         # (batch, seq_len, vocab_size)
         return self.projection_layer(x)
+
+    def forward(self, src, src_mask, tgt, tgt_mask):
+        # Teacher forced pass used for training: DistributedDataParallel only synchronizes the gradients
+        # of calls going through forward
+        encoder_output = self.encode(src, src_mask) # (batch, src_len, d_model)
+        decoder_output = self.decode(encoder_output, src_mask, tgt, tgt_mask) # (batch, tgt_len, d_model)
+        return self.project(decoder_output) # (batch, tgt_len, vocab_size)
+
+    def capture_attention_scores(self, enabled: bool = True):
+        # Keep the attention scores of every attention block (see attention_visual.ipynb)
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttentionBlock):
+                module.capture_scores = enabled
+                module.attention_scores = None
     
-def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model: int=512, N: int=6, h: int=8, dropout: float=0.1, d_ff: int=2048) -> Transformer:
+def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model: int=512, N: int=6, h: int=8, dropout: float=0.1, d_ff: int=2048, attention_backend: str='explicit', activation_checkpointing: bool=False, layer_norm_backend: str='explicit') -> Transformer:
     # Create the embedding layers
     src_embed = InputEmbeddings(d_model, src_vocab_size)
     tgt_embed = InputEmbeddings(d_model, tgt_vocab_size)
@@ -235,7 +394,7 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     # Create the encoder blocks
     encoder_blocks = []
     for _ in range(N):
-        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend)
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
         encoder_block = EncoderBlock(d_model, encoder_self_attention_block, feed_forward_block, dropout)
         encoder_blocks.append(encoder_block)
@@ -243,15 +402,15 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     # Create the decoder blocks
     decoder_blocks = []
     for _ in range(N):
-        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
-        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend)
+        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend, cross_attention=True)
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
         decoder_block = DecoderBlock(d_model, decoder_self_attention_block, decoder_cross_attention_block, feed_forward_block, dropout)
         decoder_blocks.append(decoder_block)
     
     # Create the encoder and decoder
-    encoder = Encoder(d_model, nn.ModuleList(encoder_blocks))
-    decoder = Decoder(d_model, nn.ModuleList(decoder_blocks))
+    encoder = Encoder(d_model, nn.ModuleList(encoder_blocks), activation_checkpointing)
+    decoder = Decoder(d_model, nn.ModuleList(decoder_blocks), activation_checkpointing)
     
     # Create the projection layer
     projection_layer = ProjectionLayer(d_model, tgt_vocab_size)
@@ -263,5 +422,10 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     for p in transformer.parameters():
         if p.dim() > 1:
             nn.init.xavier_uniform_(p)
+    for module in transformer.modules():
+        if isinstance(module, MultiHeadAttentionBlock):
+            module.reset_packed_parameters()
+        elif isinstance(module, LayerNormalization):
+            module.backend = layer_norm_backend
     
     return transformer
\ No newline at end of file
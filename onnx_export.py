@@ -0,0 +1,182 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+# ONNX graphs of the model, served by ONNX Runtime on the CPU:
+#   encoder.onnx:      src, src_mask --> cross_keys, cross_values, the cross-attention keys and values of every decoder layer
+#   decoder_step.onnx: token, src_mask, cross_keys, cross_values, past_keys, past_values --> logits, present_keys, present_values
+# The batch and the lengths are dynamic axes. The step appends the keys and values of the new token to the past ones,
+# the first step gets a past of length 0 (see export.DecoderStepWithPast).
+# OnnxRunner only needs onnxruntime and numpy, torch is only imported to export.
+# Run as a script to export the latest weights and check ONNX Runtime against the PyTorch model:
+#   python onnx_export.py
+
+ENCODER_FILE = 'encoder.onnx'
+DECODER_STEP_FILE = 'decoder_step.onnx'
+
+def export_onnx(model, folder, max_len: int=350, opset: int=17):
+    import torch
+    from export import EncoderExport, DecoderStepWithPast
+
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    model = model.to('cpu').eval()
+    # The step graph reads the positional encodings from the table: it must cover every position
+    model.tgt_pos.ensure_length(max_len)
+    attention = model.decoder.layers[0].self_attention_block
+    num_layers = len(model.decoder.layers)
+
+    # Example inputs, the axes named in dynamic_axes keep their size free
+    batch_size, src_len, past_len = 2, 7, 3
+    src = torch.randint(4, model.src_embed.vocab_size, (batch_size, src_len))
+    src_mask = torch.ones(batch_size, 1, 1, src_len, dtype=torch.bool)
+    token = torch.randint(4, model.tgt_embed.vocab_size, (batch_size, 1))
+    cross_keys = torch.randn(num_layers, batch_size, attention.h, src_len, attention.d_k)
+    cross_values = torch.randn_like(cross_keys)
+    past_keys = torch.randn(num_layers, batch_size, attention.h, past_len, attention.d_k)
+    past_values = torch.randn_like(past_keys)
+    cross_axes = {1: 'batch', 3: 'src_len'}
+
+    # The encoder runs the attention of the blocks: export their explicit formula, torch.onnx only exports
+    # scaled_dot_product_attention from torch 2.1
+    from model import MultiHeadAttentionBlock
+    attention_blocks = [module for module in model.modules() if isinstance(module, MultiHeadAttentionBlock)]
+    backends = [block.backend for block in attention_blocks]
+    for block in attention_blocks:
+        block.backend = 'explicit'
+
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                EncoderExport(model).eval(), (src, src_mask), str(folder / ENCODER_FILE), opset_version=opset,
+                input_names=['src', 'src_mask'], output_names=['cross_keys', 'cross_values'],
+                dynamic_axes={
+                    'src': {0: 'batch', 1: 'src_len'},
+                    'src_mask': {0: 'batch', 3: 'src_len'},
+                    'cross_keys': cross_axes,
+                    'cross_values': cross_axes,
+                })
+            torch.onnx.export(
+                DecoderStepWithPast(model).eval(), (token, src_mask, cross_keys, cross_values, past_keys, past_values),
+                str(folder / DECODER_STEP_FILE), opset_version=opset,
+                input_names=['token', 'src_mask', 'cross_keys', 'cross_values', 'past_keys', 'past_values'],
+                output_names=['logits', 'present_keys', 'present_values'],
+                dynamic_axes={
+                    'token': {0: 'batch'},
+                    'src_mask': {0: 'batch', 3: 'src_len'},
+                    'cross_keys': cross_axes,
+                    'cross_values': cross_axes,
+                    'past_keys': {1: 'batch', 3: 'past_len'},
+                    'past_values': {1: 'batch', 3: 'past_len'},
+                    'logits': {0: 'batch'},
+                    'present_keys': {1: 'batch', 3: 'total_len'},
+                    'present_values': {1: 'batch', 3: 'total_len'},
+                })
+    finally:
+        for block, backend in zip(attention_blocks, backends):
+            block.backend = backend
+
+class OnnxRunner:
+
+    def __init__(self, folder, threads: int=0, max_len: int=350):
+        # threads: intra-op threads of each session, 0 lets ONNX Runtime use one per physical core
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        # Constant folding, node fusions (attention, layer norm, gelu...) and the CPU specific layouts
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        folder = Path(folder)
+        self.encoder = ort.InferenceSession(str(folder / ENCODER_FILE), options, providers=['CPUExecutionProvider'])
+        self.step = ort.InferenceSession(str(folder / DECODER_STEP_FILE), options, providers=['CPUExecutionProvider'])
+        self.max_len = max_len
+
+    def run_encoder(self, src, src_mask):
+        return self.encoder.run(None, {'src': src, 'src_mask': src_mask})
+
+    def run_step(self, token, src_mask, cross_keys, cross_values, past_keys, past_values):
+        return self.step.run(None, {
+            'token': token, 'src_mask': src_mask, 'cross_keys': cross_keys, 'cross_values': cross_values,
+            'past_keys': past_keys, 'past_values': past_values,
+        })
+
+    def generate(self, source, source_mask, sos_idx: int, pad_idx: int):
+        # source: (batch, src_len), source_mask: (batch, 1, 1, src_len), numpy arrays or CPU tensors.
+        # Yields the next token of every row, (batch)
+        source = np.asarray(source, dtype=np.int64)
+        batch_size, src_len = source.shape
+        src_mask = np.asarray(source_mask).reshape(batch_size, 1, 1, src_len) != 0
+        cross_keys, cross_values = self.run_encoder(source, src_mask)
+        num_layers, _, h, _, d_k = cross_keys.shape
+        past_keys = np.zeros((num_layers, batch_size, h, 0, d_k), dtype=cross_keys.dtype)
+        past_values = np.zeros_like(past_keys)
+        token = np.full((batch_size, 1), sos_idx, dtype=np.int64)
+        for _ in range(self.max_len - 1):
+            logits, past_keys, past_values = self.run_step(token, src_mask, cross_keys, cross_values, past_keys, past_values)
+            next_word = logits.argmax(axis=-1) # (batch)
+            yield next_word
+            token = next_word.reshape(batch_size, 1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the latest weights to ONNX and check ONNX Runtime against PyTorch')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--sentences', nargs='+', default=['I am not a very good a student.', 'The house was quiet and the night was dark.'])
+    parser.add_argument('--steps', type=int, default=20, help='decoding steps whose logits are compared')
+    parser.add_argument('--atol', type=float, default=1e-3, help='largest difference accepted between the logits')
+    args = parser.parse_args()
+
+    import torch
+    from config import get_config
+    from export import EncoderExport
+    from greedy_search import collect_greedy
+    from translate import Translator
+
+    config = get_config()
+    # The reference is the fp32 PyTorch model
+    config['inference_backend'] = 'eager'
+    config['inference_quantization'] = None
+    translator = Translator(config, torch.device('cpu'))
+    model = translator.model
+    export_onnx(model, config['onnx_folder'], translator.seq_len, args.opset)
+    print(f"Exported {Path(config['onnx_folder']) / ENCODER_FILE} and {Path(config['onnx_folder']) / DECODER_STEP_FILE}")
+
+    runner = OnnxRunner(config['onnx_folder'], config['onnx_threads'], translator.seq_len)
+    # The sentences are tokenized with the tokenizers of the model and padded as a batch: the masks are checked too
+    source, source_mask = translator.make_source([translator.encode(sentence) for sentence in args.sentences])
+    src, src_mask = source.numpy(), source_mask.numpy() != 0
+    sos_idx, eos_idx, pad_idx = (translator.tokenizer_tgt.token_to_id(token) for token in ('[SOS]', '[EOS]', '[PAD]'))
+
+    with torch.no_grad():
+        cross_keys, cross_values = EncoderExport(model)(source, source_mask != 0)
+    ort_keys, ort_values = runner.run_encoder(src, src_mask)
+    encoder_diff = max(np.abs(ort_keys - cross_keys.numpy()).max(), np.abs(ort_values - cross_values.numpy()).max())
+    print(f"{'Encoder max difference: ':>28}{encoder_diff:.2e}")
+
+    # Both decode the tokens predicted by PyTorch, the logits of every step are compared
+    with torch.no_grad():
+        encoder_output = model.encode(source, source_mask)
+    cache = model.init_cache()
+    token = torch.full((source.size(0), 1), sos_idx, dtype=torch.int64)
+    past_keys = np.zeros(ort_keys.shape[:3] + (0,) + ort_keys.shape[4:], dtype=ort_keys.dtype)
+    past_values = np.zeros_like(past_keys)
+    step_diff = 0.0
+    for _ in range(args.steps):
+        with torch.no_grad():
+            logits = model.project(model.decode(encoder_output, source_mask, token, None, cache)[:, -1]) # (batch, vocab_size)
+        ort_logits, past_keys, past_values = runner.run_step(token.numpy(), src_mask, ort_keys, ort_values, past_keys, past_values)
+        step_diff = max(step_diff, np.abs(ort_logits - logits.numpy()).max())
+        token = logits.argmax(dim=-1, keepdim=True)
+    print(f"{'Step logits max difference: ':>28}{step_diff:.2e}")
+
+    # End to end: the greedy translations must be the same
+    torch_translations = translator.translate_batch(args.sentences)
+    ort_out = collect_greedy(runner.generate(src, src_mask, sos_idx, pad_idx), src.shape[0], sos_idx, eos_idx, pad_idx)
+    ort_translations = [translator.tokenizer_tgt.decode(row) for row in ort_out.tolist()]
+    for sentence, torch_translation, ort_translation in zip(args.sentences, torch_translations, ort_translations):
+        print(f"{'SOURCE: ':>12}{sentence}")
+        print(f"{'PYTORCH: ':>12}{torch_translation}")
+        print(f"{'ONNX: ':>12}{ort_translation}")
+
+    if max(encoder_diff, step_diff) > args.atol or torch_translations != ort_translations:
+        raise SystemExit('ONNX Runtime does not match the PyTorch model')
+    print('ONNX Runtime matches the PyTorch model')
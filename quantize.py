@@ -0,0 +1,102 @@
+import argparse
+import io
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+from config import get_config, get_quantized_weights_file_path
+from greedy_search import batch_greedy_decode
+
+# Dynamic quantization for CPU inference: the weights of every nn.Linear (the packed attention projections,
+# the feed forward layers and the vocabulary projection) are stored in int8, the activations are quantized
+# on the fly at each call. float16 only stores the weights in half precision
+QUANTIZATION_DTYPES = {
+    'qint8': torch.qint8,
+    'float16': torch.float16,
+}
+
+def quantize_model(model, dtype: str='qint8'):
+    # Quantized kernels run on the CPU only
+    model = model.to('cpu').eval()
+    return quantize_dynamic(model, {nn.Linear}, dtype=QUANTIZATION_DTYPES[dtype])
+
+def save_quantized_model(model, path, dtype: str):
+    torch.save({'quantization': dtype, 'model_state_dict': model.state_dict()}, path)
+
+def load_quantized_model(model, path):
+    # model: the fp32 model built by build_transformer, it is quantized to match the checkpoint then loaded
+    state = torch.load(path, map_location='cpu')
+    model = quantize_model(model, state['quantization'])
+    model.load_state_dict(state['model_state_dict'])
+    return model
+
+def state_dict_size(model) -> int:
+    # Size in bytes of the serialized weights
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+@torch.no_grad()
+def evaluate(model, batches, tokenizer_src, tokenizer_tgt, max_len):
+    import torchmetrics
+
+    expected, predicted = [], []
+    tokens, elapsed = 0, 0.0
+    for batch in batches:
+        start = time.perf_counter()
+        model_out = batch_greedy_decode(model, batch["encoder_input"], batch["encoder_mask"], tokenizer_src, tokenizer_tgt, max_len, 'cpu')
+        elapsed += time.perf_counter() - start
+        # Generated tokens, sos and padding excluded
+        tokens += int((model_out[:, 1:] != tokenizer_tgt.token_to_id('[PAD]')).sum())
+        predicted.extend(tokenizer_tgt.decode(row) for row in model_out.tolist())
+        expected.extend(batch["tgt_text"])
+
+    return {
+        'BLEU': float(torchmetrics.BLEUScore()(predicted, [[text] for text in expected])),
+        'CER': float(torchmetrics.CharErrorRate()(predicted, expected)),
+        'WER': float(torchmetrics.WordErrorRate()(predicted, expected)),
+        'ms/token': 1000 * elapsed / max(tokens, 1),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize the latest weights for CPU inference and check the accuracy against fp32')
+    parser.add_argument('--dtype', choices=list(QUANTIZATION_DTYPES), default='qint8')
+    parser.add_argument('--num-sentences', type=int, default=200, help='held-out validation sentences used for the check')
+    parser.add_argument('--max-bleu-drop', type=float, default=0.01, help='largest BLEU drop accepted, otherwise exit with an error')
+    args = parser.parse_args()
+
+    from train import get_ds
+    from translate import load_model
+
+    config = get_config()
+    # The reference is the fp32 model
+    config['inference_quantization'] = None
+    _, val_dataloader, _, _ = get_ds(config)
+    model, tokenizer_src, tokenizer_tgt = load_model(config, torch.device('cpu'))
+    # The same held-out sentences for both models
+    batches = []
+    for batch in val_dataloader:
+        batches.append(batch)
+        if sum(len(b["tgt_text"]) for b in batches) >= args.num_sentences:
+            break
+
+    fp32_metrics = evaluate(model, batches, tokenizer_src, tokenizer_tgt, config['seq_len'])
+    fp32_size = state_dict_size(model)
+    quantized = quantize_model(model, args.dtype)
+    quantized_metrics = evaluate(quantized, batches, tokenizer_src, tokenizer_tgt, config['seq_len'])
+    quantized_size = state_dict_size(quantized)
+
+    print(f"{'':>10}{'fp32':>12}{args.dtype:>12}")
+    for name in fp32_metrics:
+        print(f"{name:>10}{fp32_metrics[name]:>12.4f}{quantized_metrics[name]:>12.4f}")
+    print(f"{'MB':>10}{fp32_size / 2**20:>12.1f}{quantized_size / 2**20:>12.1f}")
+
+    # Only a model passing the check is saved for inference
+    bleu_drop = fp32_metrics['BLEU'] - quantized_metrics['BLEU']
+    if bleu_drop > args.max_bleu_drop:
+        raise SystemExit(f'BLEU dropped by {bleu_drop:.4f}, more than {args.max_bleu_drop}')
+    path = get_quantized_weights_file_path(config, args.dtype)
+    save_quantized_model(quantized, path, args.dtype)
+    print(f'Saved {path}, set inference_quantization to "{args.dtype}" in the config to use it')
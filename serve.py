@@ -0,0 +1,195 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from config import get_config
+from translate import Translator
+
+class TranslationRequest:
+
+    def __init__(self, ids):
+        self.ids = ids # source token ids, without <s> and </s>
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.translation = None
+        self.latency = None
+        self.error = None
+
+class BatchingTranslator:
+
+    def __init__(self, translator: Translator, max_batch_size: int=32, max_wait_ms: float=10.0):
+        # The model and the tokenizers, loaded once for the lifetime of the server
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self.queue = queue.Queue()
+        # Latencies and batch sizes of the most recent requests, for the stats
+        self.stats_lock = threading.Lock()
+        self.latencies = deque(maxlen=1000)
+        self.batch_sizes = deque(maxlen=1000)
+        self.served = 0
+
+        # A single thread runs the model, the requests of all the connections are batched together
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def translate(self, sentence: str):
+        # Called from the connection threads: tokenize here and wait for the batch worker
+        ids = self.translator.encode(sentence)
+        request = TranslationRequest(ids)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.translation, request.latency
+
+    def _next_batch(self):
+        # Wait for a first request, then gather the ones arriving within the latency window
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                translations = self.translator.translate_ids([request.ids for request in batch])
+            except Exception as error:
+                translations = [None] * len(batch)
+                for request in batch:
+                    request.error = error
+            finished = time.perf_counter()
+            with self.stats_lock:
+                for request, translation in zip(batch, translations):
+                    request.translation = translation
+                    request.latency = finished - request.arrival
+                    self.latencies.append(request.latency)
+                self.batch_sizes.append(len(batch))
+                self.served += len(batch)
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+            served = self.served
+        stats = {'queue_depth': self.queue.qsize(), 'served': served}
+        if latencies:
+            stats['latency_ms'] = {
+                'mean': 1000 * sum(latencies) / len(latencies),
+                'p50': 1000 * latencies[len(latencies) // 2],
+                'p95': 1000 * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+                'max': 1000 * latencies[-1],
+            }
+            stats['mean_batch_size'] = sum(batch_sizes) / len(batch_sizes)
+        return stats
+
+def make_handler(translator: BatchingTranslator):
+
+    class TranslationHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status: int, body: dict):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _stream(self, text: str):
+            # One JSON line per generated token. Streams are not batched: each one decodes in its connection thread
+            steps = translator.translator.stream(text)
+            try:
+                step = next(steps, None)
+            except ValueError as error:
+                self._send_json(400, {'error': str(error)})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            try:
+                while step is not None:
+                    token, piece = step
+                    self.wfile.write((json.dumps({'token': token, 'text': piece}) + '\n').encode())
+                    self.wfile.flush()
+                    step = next(steps, None)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client is gone: do not spend the remaining decoding steps
+                pass
+            finally:
+                steps.close()
+
+        def do_POST(self):
+            # POST /translate {"text": "..."} --> {"translation": "...", "latency_ms": ...}
+            # POST /translate/stream {"text": "..."} --> {"token": ..., "text": "..."} lines as the tokens are generated
+            if self.path == '/translate/stream':
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    text = body['text']
+                except (ValueError, KeyError, TypeError) as error:
+                    self._send_json(400, {'error': str(error)})
+                    return
+                self._stream(text)
+                return
+            if self.path != '/translate':
+                self._send_json(404, {'error': 'not found'})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                translation, latency = translator.translate(body['text'])
+            except (ValueError, KeyError, TypeError) as error:
+                self._send_json(400, {'error': str(error)})
+                return
+            except Exception as error:
+                self._send_json(500, {'error': str(error)})
+                return
+            self._send_json(200, {'translation': translation, 'latency_ms': 1000 * latency})
+
+        def do_GET(self):
+            # GET /stats --> queue depth, requests served, latency percentiles and mean batch size
+            if self.path != '/stats':
+                self._send_json(404, {'error': 'not found'})
+                return
+            self._send_json(200, translator.stats())
+
+        def log_message(self, format, *args):
+            # Do not print a line per request
+            pass
+
+    return TranslationHandler
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Translation server batching the concurrent requests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32, help='maximum number of sentences decoded together')
+    parser.add_argument('--max-wait-ms', type=float, default=10.0, help='how long the first request of a batch waits for others')
+    parser.add_argument('--backend', choices=['eager', 'trace', 'compile', 'onnx'], default=None, help='overrides inference_backend of the config')
+    args = parser.parse_args()
+
+    config = get_config()
+    if args.backend is not None:
+        config['inference_backend'] = args.backend
+    device = torch.device("cuda" if torch.cuda.is_available() and config['inference_backend'] != 'onnx' else "cpu")
+    print("Using device:", device)
+    translator = BatchingTranslator(Translator(config, device), args.max_batch_size, args.max_wait_ms)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(translator))
+    print(f"Serving translations on http://{args.host}:{args.port}/translate")
+    server.serve_forever()
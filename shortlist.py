@@ -0,0 +1,143 @@
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+class Shortlist:
+
+    def __init__(self, table, frequent, always):
+        # table: (src_vocab_size, top_k) target ids most associated with each source token, -1 for none
+        # frequent: the most frequent target ids, always candidates
+        # always: special target ids that must stay reachable (eos, unk)
+        self.table = torch.as_tensor(table, dtype=torch.int64)
+        self.frequent = torch.as_tensor(frequent, dtype=torch.int64)
+        self.always = torch.as_tensor(always, dtype=torch.int64)
+        # Rows whose best candidate has a lower probability fall back to the full projection, 0 never falls back
+        self.min_prob = 0.0
+
+    def save(self, path):
+        np.savez(path, table=self.table.numpy(), frequent=self.frequent.numpy(), always=self.always.numpy())
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['table'], data['frequent'], data['always'])
+
+    def candidates(self, source):
+        # source: (batch, src_len) token ids --> sorted target ids that may appear in the translations of the batch
+        rows = self.table.index_select(0, source.reshape(-1).cpu()).reshape(-1)
+        candidates = torch.cat([rows[rows >= 0], self.frequent, self.always])
+        return torch.unique(candidates).to(source.device)
+
+    def projection(self, model, source):
+        return ShortlistProjection(model, self.candidates(source), self.min_prob)
+
+class ShortlistProjection:
+
+    def __init__(self, model, candidates, min_prob: float=0.0):
+        # Only the rows of the candidates are kept from the output projection, so every step runs a
+        # (d_model, num_candidates) GEMM instead of a (d_model, vocab_size) one
+        proj = model.projection_layer.proj
+        # Dynamically quantized linears give their weight by a call
+        weight = proj.weight() if callable(proj.weight) else proj.weight
+        bias = proj.bias() if callable(proj.bias) else proj.bias
+        if weight.is_quantized:
+            weight = weight.dequantize()
+        self.model = model
+        self.candidates = candidates
+        self.vocab_size = weight.size(0)
+        self.weight = weight.index_select(0, candidates) # (num_candidates, d_model)
+        self.bias = bias.index_select(0, candidates) if bias is not None else None # (num_candidates)
+        self.min_prob = min_prob
+        self.steps = 0
+        self.fallbacks = 0
+
+    def __call__(self, x):
+        # x: (batch, d_model) --> (batch, vocab_size) logits, -inf outside of the candidates
+        logits = F.linear(x, self.weight, self.bias) # (batch, num_candidates)
+        out = torch.full((x.size(0), self.vocab_size), float('-inf'), dtype=logits.dtype, device=logits.device)
+        out[:, self.candidates] = logits
+        # The probability of the best candidate is renormalized over the candidates: when it is low, the right
+        # token is likely missing from the shortlist and the row is projected over the full vocabulary
+        self.steps += x.size(0)
+        if self.min_prob > 0:
+            low = torch.softmax(logits.float(), dim=-1).max(dim=-1).values < self.min_prob
+            if low.any():
+                out[low] = self.model.project(x[low]).to(out.dtype)
+                self.fallbacks += int(low.sum())
+        return out
+
+def build_shortlist(ds, tokenizer_src, tokenizer_tgt, src_lang: str, tgt_lang: str, top_k: int=50, num_frequent: int=500, chunk_size: int=10000):
+    # Co-occurrence counts of (source token, target token) over the sentence pairs of ds,
+    # each pair is counted once per sentence
+    src_vocab_size = tokenizer_src.get_vocab_size()
+    tgt_vocab_size = tokenizer_tgt.get_vocab_size()
+    src_counts = np.zeros(src_vocab_size, dtype=np.int64)
+    tgt_counts = np.zeros(tgt_vocab_size, dtype=np.int64)
+    pair_keys, pair_counts = [], []
+    for start in range(0, len(ds), chunk_size):
+        items = ds[start:start + chunk_size]['translation']
+        keys = []
+        for encoding_src, encoding_tgt in zip(tokenizer_src.encode_batch([item[src_lang] for item in items]), tokenizer_tgt.encode_batch([item[tgt_lang] for item in items])):
+            src_ids = np.unique(np.asarray(encoding_src.ids, dtype=np.int64))
+            tgt_ids = np.unique(np.asarray(encoding_tgt.ids, dtype=np.int64))
+            src_counts[src_ids] += 1
+            tgt_counts[tgt_ids] += 1
+            # Every (source, target) pair of the sentence, encoded as one int64 key
+            keys.append((src_ids[:, None] * tgt_vocab_size + tgt_ids[None, :]).reshape(-1))
+        if keys:
+            chunk_keys, chunk_counts = np.unique(np.concatenate(keys), return_counts=True)
+            pair_keys.append(chunk_keys)
+            pair_counts.append(chunk_counts)
+    keys, inverse = np.unique(np.concatenate(pair_keys), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(pair_counts))
+    src_ids, tgt_ids = keys // tgt_vocab_size, keys % tgt_vocab_size
+
+    # Dice coefficient of each pair: unlike the raw counts it does not favour the target tokens found everywhere,
+    # those are covered by the frequent tokens
+    dice = 2 * counts / (src_counts[src_ids] + tgt_counts[tgt_ids])
+    # Sort by source token, then by decreasing score, and keep the top_k targets of each source token
+    order = np.lexsort((-dice, src_ids))
+    src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+    rank = np.arange(len(src_ids)) - np.searchsorted(src_ids, src_ids)
+    keep = rank < top_k
+    table = np.full((src_vocab_size, top_k), -1, dtype=np.int64)
+    table[src_ids[keep], rank[keep]] = tgt_ids[keep]
+
+    frequent = np.argsort(-tgt_counts)[:num_frequent]
+    always = [tokenizer_tgt.token_to_id(token) for token in ('[EOS]', '[UNK]')]
+    return Shortlist(table, frequent, always)
+
+def get_or_build_shortlist(config, ds, tokenizer_src, tokenizer_tgt):
+    path = config['shortlist_file']
+    if Path(path).exists():
+        shortlist = Shortlist.load(path)
+    else:
+        print(f'Building shortlist {path}')
+        shortlist = build_shortlist(ds, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['shortlist_top_k'], config['shortlist_frequent'])
+        shortlist.save(path)
+    shortlist.min_prob = config['shortlist_min_prob']
+    return shortlist
+
+if __name__ == '__main__':
+    # Build the shortlist from the training sentences and report how many reference tokens of the
+    # validation sentences it covers
+    from config import get_config
+    from train import get_ds
+
+    config = get_config()
+    train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
+    shortlist = get_or_build_shortlist(config, train_dataloader.dataset.ds, tokenizer_src, tokenizer_tgt)
+
+    covered, total, num_candidates = 0, 0, []
+    for i, batch in enumerate(val_dataloader):
+        if i == 500:
+            break
+        candidates = shortlist.candidates(batch["encoder_input"])
+        labels = batch["label"][batch["label"] != tokenizer_tgt.token_to_id('[PAD]')]
+        covered += int(torch.isin(labels, candidates).sum())
+        total += labels.numel()
+        num_candidates.append(candidates.numel())
+    print(f'Reference tokens covered: {100 * covered / total:.1f}%')
+    print(f'Mean number of candidates: {sum(num_candidates) / len(num_candidates):.0f} of {tokenizer_tgt.get_vocab_size()}')
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+class TokenCache:
+
+    def __init__(self, folder):
+        # Token ids of every sentence are stored back to back in one flat file per language,
+        # the offsets index gives where each sentence starts: sentence i is ids[offsets[i]:offsets[i + 1]]
+        folder = Path(folder)
+        self.folder = folder
+        self.src_offsets = np.load(folder / 'src_offsets.npy')
+        self.tgt_offsets = np.load(folder / 'tgt_offsets.npy')
+        # Memory-map the ids: nothing is read until a sentence is accessed and the pages are shared between processes
+        self.src_ids = np.memmap(folder / 'src_ids.bin', dtype=np.int32, mode='r')
+        self.tgt_ids = np.memmap(folder / 'tgt_ids.bin', dtype=np.int32, mode='r')
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def __getstate__(self):
+        # DataLoader workers re-open the files instead of receiving a copy of the ids
+        return {'folder': self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(state['folder'])
+
+    def src(self, idx):
+        # Zero-copy view of the source token ids of the sentence
+        return self.src_ids[self.src_offsets[idx]:self.src_offsets[idx + 1]]
+
+    def tgt(self, idx):
+        # Zero-copy view of the target token ids of the sentence
+        return self.tgt_ids[self.tgt_offsets[idx]:self.tgt_offsets[idx + 1]]
+
+    @property
+    def src_lengths(self):
+        return np.diff(self.src_offsets)
+
+    @property
+    def tgt_lengths(self):
+        return np.diff(self.tgt_offsets)
+
+def file_hash(path) -> str:
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+def get_token_cache_folder(config, split: str):
+    # The cache is only valid for the tokenizers and the dataset split it was built with
+    key = hashlib.sha256(json.dumps({
+        'datasource': config['datasource'],
+        'langs': f"{config['lang_src']}-{config['lang_tgt']}",
+        'split': split,
+        'tokenizer_src': file_hash(config['tokenizer_file'].format(config['lang_src'])),
+        'tokenizer_tgt': file_hash(config['tokenizer_file'].format(config['lang_tgt'])),
+    }, sort_keys=True).encode()).hexdigest()[:16]
+    return Path(config['token_cache_folder']) / f"{config['datasource']}_{split}_{key}"
+
+def build_token_cache(folder, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, chunk_size: int=10000):
+    folder = Path(folder)
+    # Write to a temporary folder and rename it once complete, so an interrupted build is never used
+    tmp_folder = folder.with_name(folder.name + '.tmp')
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tmp_folder.mkdir(parents=True)
+
+    src_offsets = [0]
+    tgt_offsets = [0]
+    with open(tmp_folder / 'src_ids.bin', 'wb') as src_file, open(tmp_folder / 'tgt_ids.bin', 'wb') as tgt_file:
+        for start in range(0, len(ds), chunk_size):
+            items = ds[start:start + chunk_size]['translation']
+            # encode_batch tokenizes the whole chunk in parallel
+            for encoding_src, encoding_tgt in zip(tokenizer_src.encode_batch([item[src_lang] for item in items]), tokenizer_tgt.encode_batch([item[tgt_lang] for item in items])):
+                np.asarray(encoding_src.ids, dtype=np.int32).tofile(src_file)
+                np.asarray(encoding_tgt.ids, dtype=np.int32).tofile(tgt_file)
+                src_offsets.append(src_offsets[-1] + len(encoding_src.ids))
+                tgt_offsets.append(tgt_offsets[-1] + len(encoding_tgt.ids))
+
+    np.save(tmp_folder / 'src_offsets.npy', np.asarray(src_offsets, dtype=np.int64))
+    np.save(tmp_folder / 'tgt_offsets.npy', np.asarray(tgt_offsets, dtype=np.int64))
+    tmp_folder.rename(folder)
+
+def get_or_build_token_cache(config, ds, tokenizer_src, tokenizer_tgt, split: str):
+    folder = get_token_cache_folder(config, split)
+    if not folder.exists():
+        print(f'Building token cache {folder}')
+        build_token_cache(folder, ds, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'])
+    return TokenCache(folder)
+
+if __name__ == '__main__':
+    # Build the token cache ahead of training
+    from config import get_config
+    from datasets import load_dataset
+    from train import get_or_build_tokenizer
+
+    config = get_config()
+    ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
+    tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
+    tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+    token_cache = get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt, 'train')
+    print(f'{len(token_cache)} sentences in {get_token_cache_folder(config, "train")}')
@@ -1,60 +1,35 @@
-from model import build_transformer
-from dataset import BilingualDataset, causal_mask
-from config import get_config, get_weights_file_path, latest_weights_file_path
+from model import build_transformer, MultiHeadAttentionBlock
+from dataset import BilingualDataset, BilingualCollate, LengthBucketBatchSampler, ResumableBatchSampler, causal_mask, dataloader_kwargs
+from beam_search import beam_search
+from greedy_search import batch_greedy_decode, greedy_decode # greedy_decode is imported from here by the notebooks
+from token_cache import get_or_build_token_cache
+from config import get_config, get_weights_file_path, latest_weights_file_path, weights_file_paths
+from checkpoint import AsyncCheckpointWriter
+from metrics import MetricsLogger, make_sinks
+from distributed import init_distributed, cleanup_distributed, is_distributed, is_main_process, get_rank, get_world_size, barrier
 
-import torchtext.datasets as datasets
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, BatchSampler, DistributedSampler, random_split
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import LambdaLR
 
 import warnings
-from tqdm import tqdm
+import contextlib
+import math
+import time
 import os
 from pathlib import Path
 
-# Huggingface datasets and tokenizers
-from datasets import load_dataset
+# Huggingface tokenizers
 from tokenizers import Tokenizer
 from tokenizers.models import WordLevel
 from tokenizers.trainers import WordLevelTrainer
 from tokenizers.pre_tokenizers import Whitespace
 
-import torchmetrics
-from torch.utils.tensorboard import SummaryWriter
+# datasets, torchmetrics, tensorboard, wandb and tqdm are slow to import: they are imported by the functions using them
 
-def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device):
-    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
-    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
-
-    # Precompute the encoder output and reuse it for every step
-    encoder_output = model.encode(source, source_mask)
-    # Initialize the decoder input with the sos token
-    decoder_input = torch.empty(1, 1).fill_(sos_idx).type_as(source).to(device)
-    while True:
-        if decoder_input.size(1) == max_len:
-            break
-
-        # build mask for target
-        decoder_mask = causal_mask(decoder_input.size(1)).type_as(source_mask).to(device)
-
-        # calculate output
-        out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask)
-
-        # get next token
-        prob = model.project(out[:, -1])
-        _, next_word = torch.max(prob, dim=1)
-        decoder_input = torch.cat(
-            [decoder_input, torch.empty(1, 1).type_as(source).fill_(next_word.item()).to(device)], dim=1
-        )
-
-        if next_word == eos_idx:
-            break
-
-    return decoder_input.squeeze(0)
-
-
-def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, writer, num_examples=2):
+def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_step, metrics, num_examples=2, beam_size=1):
     model.eval()
     count = 0
 
@@ -73,53 +48,48 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
 
     with torch.no_grad():
         for batch in validation_ds:
-            count += 1
             encoder_input = batch["encoder_input"].to(device) # (b, seq_len)
             encoder_mask = batch["encoder_mask"].to(device) # (b, 1, 1, seq_len)
 
-            # check that the batch size is 1
-            assert encoder_input.size(
-                0) == 1, "Batch size must be 1 for validation"
+            # Decode the whole batch at once
+            if beam_size > 1:
+                model_out, _ = beam_search(model, encoder_input, encoder_mask, tokenizer_tgt.token_to_id('[SOS]'), tokenizer_tgt.token_to_id('[EOS]'), tokenizer_tgt.token_to_id('[PAD]'), beam_size, max_len)
+            else:
+                model_out = batch_greedy_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device)
 
-            model_out = greedy_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device)
+            for i in range(encoder_input.size(0)):
+                count += 1
+                source_text = batch["src_text"][i]
+                target_text = batch["tgt_text"][i]
+                # The special tokens, including the padding after eos, are skipped by decode
+                model_out_text = tokenizer_tgt.decode(model_out[i].detach().cpu().numpy())
 
-            source_text = batch["src_text"][0]
-            target_text = batch["tgt_text"][0]
-            model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
+                source_texts.append(source_text)
+                expected.append(target_text)
+                predicted.append(model_out_text)
 
-            source_texts.append(source_text)
-            expected.append(target_text)
-            predicted.append(model_out_text)
-            
-            # Print the source, target and model output
-            print_msg('-'*console_width)
-            print_msg(f"{f'SOURCE: ':>12}{source_text}")
-            print_msg(f"{f'TARGET: ':>12}{target_text}")
-            print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
+                # Print the source, target and model output
+                print_msg('-'*console_width)
+                print_msg(f"{f'SOURCE: ':>12}{source_text}")
+                print_msg(f"{f'TARGET: ':>12}{target_text}")
+                print_msg(f"{f'PREDICTED: ':>12}{model_out_text}")
+
+                if count == num_examples:
+                    break
 
             if count == num_examples:
                 print_msg('-'*console_width)
                 break
     
-    if writer:
-        # Evaluate the character error rate
-        # Compute the char error rate 
-        metric = torchmetrics.CharErrorRate()
-        cer = metric(predicted, expected)
-        writer.add_scalar('validation cer', cer, global_step)
-        writer.flush()
-
-        # Compute the word error rate
-        metric = torchmetrics.WordErrorRate()
-        wer = metric(predicted, expected)
-        writer.add_scalar('validation wer', wer, global_step)
-        writer.flush()
-
-        # Compute the BLEU metric
-        metric = torchmetrics.BLEUScore()
-        bleu = metric(predicted, expected)
-        writer.add_scalar('validation BLEU', bleu, global_step)
-        writer.flush()
+    if metrics:
+        import torchmetrics
+
+        # Compute the char error rate, the word error rate and the BLEU metric
+        metrics.log({
+            'validation/cer': torchmetrics.CharErrorRate()(predicted, expected),
+            'validation/wer': torchmetrics.WordErrorRate()(predicted, expected),
+            'validation/BLEU': torchmetrics.BLEUScore()(predicted, expected),
+        }, global_step)
 
 def get_all_sentences(ds, lang):
     for item in ds:
@@ -139,45 +109,160 @@ def get_or_build_tokenizer(config, ds, lang):
     return tokenizer
 
 def get_ds(config):
+    from datasets import load_dataset
+
     # It only has the train split, so we divide it overselves
     ds_raw = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='train')
 
+    # In distributed training the first process builds the tokenizers and the token cache, the others wait and load them
+    if not is_main_process():
+        barrier()
+
     # Build tokenizers
     tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
     tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
 
     # Keep 90% for training, 10% for validation
+    # The split is seeded so that the validation sentences stay held out when evaluating the model later
     train_ds_size = int(0.9 * len(ds_raw))
     val_ds_size = len(ds_raw) - train_ds_size
-    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
+    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size], generator=torch.Generator().manual_seed(config['split_seed']))
 
-    train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
-    val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
+    # Tokenize the dataset once and memory-map the token ids, instead of tokenizing every sample at every epoch
+    token_cache = get_or_build_token_cache(config, ds_raw, tokenizer_src, tokenizer_tgt, 'train') if config['token_cache'] else None
+    if is_main_process():
+        barrier()
 
-    # Find the maximum length of each sentence in the source and target sentence
-    max_len_src = 0
-    max_len_tgt = 0
+    train_ds = BilingualDataset(train_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'], token_cache)
+    val_ds = BilingualDataset(val_ds_raw, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'], token_cache)
 
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
+    # Find the length of each sentence in the source and target sentence
+    if token_cache is not None:
+        # The lengths are given by the offsets index of the cache
+        src_lengths = token_cache.src_lengths.tolist()
+        tgt_lengths = token_cache.tgt_lengths.tolist()
+    else:
+        src_lengths = []
+        tgt_lengths = []
+        for item in ds_raw:
+            src_lengths.append(len(tokenizer_src.encode(item['translation'][config['lang_src']]).ids))
+            tgt_lengths.append(len(tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids))
+    max_len_src = max(src_lengths)
+    max_len_tgt = max(tgt_lengths)
+    # Padded length of each sample, used to bucket the samples by length
+    # <s> and </s> are added to the source, only one of them to the target
+    sample_lengths = [max(src_len + 2, tgt_len + 1) for src_len, tgt_len in zip(src_lengths, tgt_lengths)]
 
     print(f'Max length of source sentence: {max_len_src}')
     print(f'Max length of target sentence: {max_len_tgt}')
     
 
-    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+    # Worker processes, pinned memory and prefetching
+    loader_kwargs = dataloader_kwargs(config)
+    if config['dynamic_batching']:
+        # Group samples of similar length and pad them only to the longest one of their batch,
+        # the batch size is set by the max_tokens budget
+        collate_fn = BilingualCollate(tokenizer_tgt.token_to_id('[SOS]'), tokenizer_tgt.token_to_id('[EOS]'), tokenizer_tgt.token_to_id('[PAD]'))
+        # In distributed training each process takes its share of the batches. The batches are shuffled with the
+        # seed and the epoch, so that a run resumed during an epoch sees them in the same order
+        train_sampler = LengthBucketBatchSampler([sample_lengths[i] for i in train_ds_raw.indices], config['max_tokens'], num_replicas=get_world_size(), rank=get_rank(), seed=config['split_seed'])
+    else:
+        collate_fn = BilingualCollate(tokenizer_tgt.token_to_id('[SOS]'), tokenizer_tgt.token_to_id('[EOS]'), tokenizer_tgt.token_to_id('[PAD]'), config['seq_len'])
+        # Each process takes its share of the shuffled samples (all of them without distributed training),
+        # batch_size is the batch of one process. The order is set by the seed and the epoch only
+        train_sampler = BatchSampler(DistributedSampler(train_ds, num_replicas=get_world_size(), rank=get_rank(), shuffle=True, seed=config['split_seed'], drop_last=True), config['batch_size'], drop_last=False)
+    # A run resumed during an epoch starts after the batches it had trained, see train_model
+    train_dataloader = DataLoader(train_ds, batch_sampler=ResumableBatchSampler(train_sampler), collate_fn=collate_fn, **loader_kwargs)
+    val_dataloader = DataLoader(val_ds, batch_size=config['val_batch_size'], shuffle=True, collate_fn=collate_fn)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
 def get_model(config, vocab_src_len, vocab_tgt_len):
-    model = build_transformer(vocab_src_len, vocab_tgt_len, config["seq_len"], config['seq_len'], d_model=config['d_model'])
+    model = build_transformer(vocab_src_len, vocab_tgt_len, config["seq_len"], config['seq_len'], d_model=config['d_model'], attention_backend=config['attention_backend'], activation_checkpointing=config['activation_checkpointing'], layer_norm_backend=config['layer_norm_backend'])
     return model
 
+def get_optimizer(config, model, lr: float):
+    # foreach updates all the parameters with a few multi-tensor kernels instead of one loop per parameter,
+    # fused runs the whole update in a single kernel
+    impl = {'default': {}, 'foreach': {'foreach': True}, 'fused': {'fused': True}}[config['optimizer_impl']]
+    device = next(model.parameters()).device
+    torch_version = tuple(int(part) for part in torch.__version__.split('+')[0].split('.')[:2])
+    if config['optimizer_impl'] == 'fused' and device.type != 'cuda' and torch_version < (2, 4):
+        # Before torch 2.4 the fused Adam kernel only exists for CUDA
+        raise ValueError(f"optimizer_impl 'fused' needs torch >= 2.4 on {device.type} (found {torch.__version__}), use 'foreach'")
+    return torch.optim.Adam(model.parameters(), lr=lr, eps=1e-9, **impl)
+
+def convert_packed_optimizer_state(model, model_state_dict, optimizer_state_dict):
+    # Checkpoints saved before the attention projections were packed have separate w_q, w_k and w_v weights
+    # (see MultiHeadAttentionBlock._load_from_state_dict), and their optimizer state has one entry per separate
+    # weight. Stack the Adam moments of those entries like the weights, so that training resumes with them.
+    # Returns the optimizer state dict as it is when it already matches the model, None when it cannot be converted
+    old_names = []
+    packed = {} # name of the packed parameter --> names of the separate parameters it replaces
+    for name, _ in model.named_parameters():
+        prefix, _, param_name = name.rpartition('.')
+        module_name, _, linear_name = prefix.rpartition('.')
+        module = model.get_submodule(module_name) if module_name else model
+        if isinstance(module, MultiHeadAttentionBlock) and param_name == 'weight' and linear_name == module.packed_projections()[0]:
+            packed[name] = [f'{module_name}.{separate}.weight' for separate in module.packed_projections()[1]]
+            old_names.extend(packed[name])
+        else:
+            old_names.append(name)
+    if not any(separate in model_state_dict for names in packed.values() for separate in names):
+        return optimizer_state_dict
+
+    param_groups = optimizer_state_dict['param_groups']
+    if len(param_groups) != 1 or len(param_groups[0]['params']) != len(old_names):
+        return None
+    # The optimizer state is indexed by the position of the parameter in model.parameters()
+    old_state = {name: optimizer_state_dict['state'].get(index) for name, index in zip(old_names, param_groups[0]['params'])}
+    state = {}
+    for index, (name, _) in enumerate(model.named_parameters()):
+        entries = [old_state[separate] for separate in packed.get(name, [name])]
+        if any(entry is None for entry in entries):
+            continue
+        # exp_avg, exp_avg_sq (and max_exp_avg_sq) are stacked along the output dimension like the weights,
+        # the step count is the same for every entry
+        state[index] = {key: torch.cat([entry[key] for entry in entries], dim=0) if isinstance(value, torch.Tensor) and value.dim() > 0 else value for key, value in entries[0].items()}
+    return {'state': state, 'param_groups': [{**param_groups[0], 'params': list(range(len(list(model.parameters()))))}]}
+
+def get_peak_lr(config, train_dataloader):
+    # Linear scaling rule: the peak learning rate grows with the effective batch size, relative to the
+    # batch size config['lr'] was tuned for. With dynamic batching the batch size is the mean number of samples
+    # of the batches of one process, which depends on the lengths of the samples
+    if not config['lr_scaling']:
+        return config['lr']
+    if config['dynamic_batching']:
+        batch_size = len(train_dataloader.dataset) / (len(train_dataloader) * get_world_size())
+    else:
+        batch_size = config['batch_size']
+    effective_batch_size = batch_size * config['grad_accum_steps'] * get_world_size()
+    return config['lr'] * effective_batch_size / config['lr_reference_batch_size']
+
+def get_lr_lambda(config, total_steps: int):
+    # Factor of the peak learning rate at each optimizer step
+    warmup = max(config['warmup_steps'], 1)
+    schedule = config['lr_schedule']
+    def lr_lambda(step):
+        # LambdaLR starts at step 0, before the first update
+        step = step + 1
+        if schedule == 'constant':
+            return 1.0
+        if schedule == 'inverse_sqrt':
+            # Attention Is All You Need: linear warmup, then decay with the inverse square root of the step
+            return min(step / warmup, (warmup / step) ** 0.5)
+        if schedule == 'cosine':
+            # Linear warmup, then cosine decay to 0 at the last step of the training
+            if step < warmup:
+                return step / warmup
+            progress = min((step - warmup) / max(total_steps - warmup, 1), 1.0)
+            return 0.5 * (1 + math.cos(math.pi * progress))
+        raise ValueError(f"Unknown lr_schedule {schedule}")
+    return lr_lambda
+
 def train_model(config):
+    from tqdm import tqdm
+
     # Define the device
     device = "cuda" if torch.cuda.is_available() else "mps" if torch.has_mps or torch.backends.mps.is_available() else "cpu"
     print("Using device:", device)
@@ -191,81 +276,189 @@ def train_model(config):
         print("      On a Windows machine with NVidia GPU, check this video: https://www.youtube.com/watch?v=GMSjDTU8Zlc")
         print("      On a Mac machine, run: pip3 install --pre torch torchvision torchaudio torchtext --index-url https://download.pytorch.org/whl/nightly/cpu")
     device = torch.device(device)
+    # Launched with torchrun: one process per replica, see distributed.py
+    device = init_distributed(config) or device
+    if is_distributed():
+        print(f"Process {get_rank()} of {get_world_size()}, using device: {device}")
 
     # Make sure the weights folder exists
     Path(f"{config['datasource']}_{config['model_folder']}").mkdir(parents=True, exist_ok=True)
 
     train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
     model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
-    # Tensorboard
-    writer = SummaryWriter(config['experiment_name'])
-
-    optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-9)
+    # Tensorboard and/or W&B, written in the background. Only the first process logs
+    metrics = MetricsLogger(make_sinks(config) if is_main_process() else [], config['log_every_steps'])
+
+    optimizer = get_optimizer(config, model, get_peak_lr(config, train_dataloader))
+    # The gradients of grad_accum_steps micro-batches are accumulated into one optimizer step,
+    # global_step counts the optimizer steps. The learning rate schedule is stepped at every optimizer step
+    accum_steps = config['grad_accum_steps']
+    total_steps = math.ceil(len(train_dataloader) / accum_steps) * config['num_epochs']
+    lr_lambda = get_lr_lambda(config, total_steps)
+    scheduler = LambdaLR(optimizer, lr_lambda)
+
+    # Mixed precision: the forward pass runs under autocast while the weights, the optimizer and the loss stay in fp32.
+    # Only fp16 needs the loss scaling, bf16 has the fp32 exponent range
+    amp_dtype = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[config['precision']]
+    if amp_dtype == torch.float16 and device.type != 'cuda':
+        # torch.cuda.amp.GradScaler disables itself on other devices: fp16 would train without loss scaling
+        raise ValueError(f"precision 'fp16' needs a CUDA device for the loss scaling, use 'bf16' on {device.type}")
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
 
     # If the user specified a model to preload before training, load it
     initial_epoch = 0
     global_step = 0
+    # Micro-batches of initial_epoch already trained when resuming from a checkpoint saved during that epoch
+    resume_batches = 0
     preload = config['preload']
     model_filename = latest_weights_file_path(config) if preload == 'latest' else get_weights_file_path(config, preload) if preload else None
     if model_filename:
         print(f'Preloading model {model_filename}')
-        state = torch.load(model_filename)
+        # Every process loads the checkpoint, so that the optimizer states are the same on all of them
+        state = torch.load(model_filename, map_location=device)
         model.load_state_dict(state['model_state_dict'])
-        initial_epoch = state['epoch'] + 1
-        optimizer.load_state_dict(state['optimizer_state_dict'])
+        # A checkpoint saved during an epoch resumes that epoch after the batches it had trained.
+        # Checkpoints saved without the count restart the epoch
+        if state.get('epoch_complete', True):
+            initial_epoch = state['epoch'] + 1
+        else:
+            initial_epoch = state['epoch']
+            resume_batches = state.get('epoch_batches_done', 0)
+        # Checkpoints from before the packed attention projections get their optimizer state converted
+        optimizer_state = convert_packed_optimizer_state(model, state['model_state_dict'], state['optimizer_state_dict'])
+        if optimizer_state is not None:
+            optimizer.load_state_dict(optimizer_state)
+        else:
+            print('The optimizer state of the checkpoint does not match the model, the optimizer starts from scratch')
         global_step = state['global_step']
+        if 'scaler_state_dict' in state:
+            scaler.load_state_dict(state['scaler_state_dict'])
+        if 'scheduler_state_dict' in state:
+            scheduler.load_state_dict(state['scheduler_state_dict'])
+        else:
+            # Checkpoint saved without a schedule: continue the schedule from global_step
+            scheduler.last_epoch = global_step
+            for group, base_lr in zip(optimizer.param_groups, scheduler.base_lrs):
+                group['lr'] = base_lr * lr_lambda(global_step)
     else:
         print('No model to preload, starting from scratch')
 
     loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id('[PAD]'), label_smoothing=0.1).to(device)
 
+    # The checkpoints and the validation use the model itself, the training steps go through the
+    # DistributedDataParallel wrapper which averages the gradients of the processes
+    raw_model = model
+    if is_distributed():
+        # The only buffers are the positional encoding tables, which every process computes itself:
+        # do not send them from the first process before every forward pass
+        model = DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None, broadcast_buffers=False)
+
+    # Checkpoints are written by a background thread, training only waits for the copy of the state
+    checkpoint_writer = AsyncCheckpointWriter(config['keep_last_checkpoints'], lambda: weights_file_paths(config))
+
+    def save_checkpoint(epoch, epoch_complete: bool, batches_done: int=0):
+        # The processes all have the same weights, the first one writes them
+        if not is_main_process():
+            return
+        state = {
+            'epoch': epoch,
+            'epoch_complete': epoch_complete,
+            'model_state_dict': raw_model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
+            'scheduler_state_dict': scheduler.state_dict(),
+            'global_step': global_step,
+            # Micro-batches of the epoch trained so far, skipped when resuming from a checkpoint saved during the epoch
+            'epoch_batches_done': batches_done,
+        }
+        if epoch_complete:
+            # Inference only needs the weights: write them without the optimizer state, in a file that can be memory-mapped
+            checkpoint_writer.save(get_weights_file_path(config, f"{epoch:02d}"), state, get_weights_file_path(config, f"{epoch:02d}", '.safetensors'))
+        else:
+            checkpoint_writer.save(get_weights_file_path(config, f"{epoch:02d}-{global_step}"), state)
+
     for epoch in range(initial_epoch, config['num_epochs']):
         torch.cuda.empty_cache()
         model.train()
-        batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}")
-        for batch in batch_iterator:
-
-            encoder_input = batch['encoder_input'].to(device) # (b, seq_len)
-            decoder_input = batch['decoder_input'].to(device) # (B, seq_len)
-            encoder_mask = batch['encoder_mask'].to(device) # (B, 1, 1, seq_len)
-            decoder_mask = batch['decoder_mask'].to(device) # (B, 1, seq_len, seq_len)
+        # The samplers shuffle by epoch, the same way in every process and in a resumed run
+        train_dataloader.batch_sampler.set_epoch(epoch)
+        # Resuming from a checkpoint saved during this epoch: the sampler skips the batches already trained,
+        # they are not loaded
+        skip_batches = resume_batches if epoch == initial_epoch else 0
+        if skip_batches:
+            print(f'Resuming epoch {epoch:02d} after its first {skip_batches} batches')
+            train_dataloader.batch_sampler.skip_batches(skip_batches)
+        batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}", initial=skip_batches, disable=not is_main_process())
+        num_batches = len(train_dataloader)
+        # Time spent waiting for the next batch versus running the training step
+        metrics.start_epoch()
+        step_end = time.perf_counter()
+        for micro_step, batch in enumerate(batch_iterator, start=skip_batches):
+            metrics.add_data_time(time.perf_counter() - step_end)
+
+            # non_blocking copies overlap with compute when the batch is in pinned memory
+            encoder_input = batch['encoder_input'].to(device, non_blocking=True) # (b, seq_len)
+            decoder_input = batch['decoder_input'].to(device, non_blocking=True) # (B, seq_len)
+            encoder_mask = batch['encoder_mask'].to(device, non_blocking=True) # (B, 1, 1, seq_len)
+            # The batch only has the padding of the decoder input, combine it with the shared causal mask
+            decoder_mask = batch['decoder_mask'].to(device, non_blocking=True) & causal_mask(decoder_input.size(1), device) # (B, 1, 1, seq_len) & (1, seq_len, seq_len)
+
+            # Number of micro-batches of the current optimizer step, the last one of the epoch may be shorter
+            group_size = min(accum_steps, num_batches - micro_step // accum_steps * accum_steps)
+            last_micro_step = (micro_step + 1) % accum_steps == 0 or micro_step + 1 == num_batches
+            # In distributed training the gradients are only averaged across the processes at the last micro-batch
+            skip_sync = is_distributed() and not last_micro_step
 
             # Run the tensors through the encoder, decoder and the projection layer
-            encoder_output = model.encode(encoder_input, encoder_mask) # (B, seq_len, d_model)
-            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask) # (B, seq_len, d_model)
-            proj_output = model.project(decoder_output) # (B, seq_len, vocab_size)
+            with model.no_sync() if skip_sync else contextlib.nullcontext(), torch.autocast(device.type, dtype=amp_dtype) if amp_dtype is not None else contextlib.nullcontext():
+                proj_output = model(encoder_input, encoder_mask, decoder_input, decoder_mask) # (B, seq_len, vocab_size)
 
             # Compare the output with the label
-            label = batch['label'].to(device) # (B, seq_len)
+            label = batch['label'].to(device, non_blocking=True) # (B, seq_len)
+
+            # Compute the loss using a simple cross entropy, in fp32
+            loss = loss_fn(proj_output.float().view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
+
+            # Log the loss, it is only read from the device every log_every_steps micro-batches
+            scalars = metrics.log_step(loss, int((batch['label'] != tokenizer_tgt.token_to_id('[PAD]')).sum()), label.size(0), global_step)
+            if scalars is not None:
+                metrics.log({'train/lr': scheduler.get_last_lr()[0]}, global_step)
+                batch_iterator.set_postfix({"loss": f"{scalars['train/loss']:6.3f}", "tokens/s": f"{scalars['train/tokens_per_sec']:.0f}"})
+
+            # Backpropagate the loss, averaged over the micro-batches and scaled when training in fp16
+            with model.no_sync() if skip_sync else contextlib.nullcontext():
+                scaler.scale(loss / group_size).backward()
 
-            # Compute the loss using a simple cross entropy
-            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
-            batch_iterator.set_postfix({"loss": f"{loss.item():6.3f}"})
+            # Update the weights once all the micro-batches of the step are accumulated
+            if last_micro_step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                scheduler.step()
 
-            # Log the loss
-            writer.add_scalar('train loss', loss.item(), global_step)
-            writer.flush()
+                global_step += 1
 
-            # Backpropagate the loss
-            loss.backward()
+                # Checkpoint during the epoch every checkpoint_every_steps optimizer steps
+                if config['checkpoint_every_steps'] and global_step % config['checkpoint_every_steps'] == 0:
+                    save_checkpoint(epoch, epoch_complete=False, batches_done=micro_step + 1)
 
-            # Update the weights
-            optimizer.step()
-            optimizer.zero_grad(set_to_none=True)
+            step_end = time.perf_counter()
 
-            global_step += 1
+        data_time, compute_time = metrics.end_epoch(global_step)
+        if is_main_process():
+            batch_iterator.write(f"Data wait: {data_time:.1f}s, compute: {compute_time:.1f}s ({100 * data_time / max(data_time + compute_time, 1e-9):.1f}% of the epoch waiting for data)")
 
-        # Run validation at the end of every epoch
-        run_validation(model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, writer)
+        # Run validation at the end of every epoch, in the first process only
+        if is_main_process():
+            run_validation(raw_model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, metrics)
 
         # Save the model at the end of every epoch
-        model_filename = get_weights_file_path(config, f"{epoch:02d}")
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': global_step
-        }, model_filename)
+        save_checkpoint(epoch, epoch_complete=True)
+
+    # Wait for the last checkpoint and the last metrics to be written
+    checkpoint_writer.close()
+    metrics.close()
+    cleanup_distributed()
 
 
 if __name__ == '__main__':
@@ -1,79 +1,222 @@
 from pathlib import Path
-from config import get_config, latest_weights_file_path 
+from config import get_config, latest_weights_file_path, get_quantized_weights_file_path
 from model import build_transformer
 from tokenizers import Tokenizer
-from datasets import load_dataset
-from dataset import BilingualDataset
+from beam_search import beam_search
+from greedy_search import batch_greedy_decode, greedy_steps, collect_greedy
+from weights_file import load_model_weights
 import torch
-import sys
 
-def translate(sentence: str):
-    # Define the device, tokenizers, and model
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("Using device:", device)
-    config = get_config()
+# Only what decoding needs is imported here: datasets is imported when a sentence is read from the dataset,
+# so that short-lived translation workers start fast
+
+def load_tokenizers(config):
     tokenizer_src = Tokenizer.from_file(str(Path(config['tokenizer_file'].format(config['lang_src']))))
     tokenizer_tgt = Tokenizer.from_file(str(Path(config['tokenizer_file'].format(config['lang_tgt']))))
-    model = build_transformer(tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size(), config["seq_len"], config['seq_len'], d_model=config['d_model']).to(device)
+    return tokenizer_src, tokenizer_tgt
+
+def load_model(config, device):
+    # Load the tokenizers and the latest weights
+    tokenizer_src, tokenizer_tgt = load_tokenizers(config)
+    model = build_transformer(tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size(), config["seq_len"], config['seq_len'], d_model=config['d_model'], attention_backend=config['attention_backend'], layer_norm_backend=config['layer_norm_backend'])
+    if config['inference_quantization']:
+        # Checkpoint written by quantize.py, the quantized model runs on the CPU
+        from quantize import load_quantized_model
+        if torch.device(device).type != 'cpu':
+            raise ValueError("Quantized inference runs on the CPU only")
+        model = load_quantized_model(model, get_quantized_weights_file_path(config, config['inference_quantization']))
+        return model.eval(), tokenizer_src, tokenizer_tgt
+    # Memory-map the inference weights file when there is one, instead of unpickling the whole training checkpoint
+    weights_filename = latest_weights_file_path(config, '.safetensors')
+    if weights_filename:
+        model = load_model_weights(model, weights_filename, device).to(device)
+    else:
+        model = model.to(device)
+        state = torch.load(latest_weights_file_path(config), map_location=device)
+        model.load_state_dict(state['model_state_dict'])
+    model.eval()
+    return model, tokenizer_src, tokenizer_tgt
+
+class Translator:
+
+    def __init__(self, config=None, device=None):
+        self.config = config if config is not None else get_config()
+        self.device = device if device is not None else torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.seq_len = self.config['seq_len']
+        if self.config['inference_backend'] == 'onnx':
+            # The graphs exported by onnx_export.py run under ONNX Runtime on the CPU, the PyTorch model is not loaded
+            self.device = torch.device('cpu')
+            self.model = None
+            self.tokenizer_src, self.tokenizer_tgt = load_tokenizers(self.config)
+        else:
+            self.model, self.tokenizer_src, self.tokenizer_tgt = load_model(self.config, self.device)
+        self.sos_idx = self.tokenizer_src.token_to_id('[SOS]')
+        self.eos_idx = self.tokenizer_src.token_to_id('[EOS]')
+        self.pad_idx = self.tokenizer_src.token_to_id('[PAD]')
+        # Traced or compiled graphs of the encoder and of one decoding step (see export.py), or their ONNX
+        # Runtime sessions (see onnx_export.py), for greedy decoding
+        self.runner = None
+        if self.config['inference_backend'] == 'onnx':
+            from onnx_export import OnnxRunner
+            self.runner = OnnxRunner(self.config['onnx_folder'], self.config['onnx_threads'], max_len=self.seq_len)
+        elif self.config['inference_backend'] != 'eager':
+            from export import StepRunner
+            weights_filename = latest_weights_file_path(self.config, '.safetensors') or latest_weights_file_path(self.config)
+            # The graphs depend on the weights and on the ops the model runs (the source of the modules is added by StepRunner)
+            model_id = f"{weights_filename}|{Path(weights_filename).stat().st_mtime}|{self.config['inference_quantization']}|{self.config['attention_backend']}|{self.config['layer_norm_backend']}"
+            self.runner = StepRunner(self.model, self.config['inference_backend'], self.config['compile_cache_dir'], model_id, max_len=self.seq_len)
+        # Restrict the output projection to the likely target tokens, the table is built by shortlist.py
+        self.shortlist = None
+        if self.config['shortlist']:
+            from shortlist import Shortlist
+            self.shortlist = Shortlist.load(self.config['shortlist_file'])
+            self.shortlist.min_prob = self.config['shortlist_min_prob']
+
+    def encode(self, sentence: str):
+        # Source token ids, without <s> and </s>
+        ids = self.tokenizer_src.encode(sentence).ids
+        if len(ids) + 2 > self.seq_len:
+            raise ValueError("Sentence is too long")
+        return ids
+
+    def make_source(self, batch_ids):
+        # Pad the sources to the longest one of the batch
+        source = torch.full((len(batch_ids), max(len(ids) for ids in batch_ids) + 2), self.pad_idx, dtype=torch.int64)
+        for i, ids in enumerate(batch_ids):
+            source[i, :len(ids) + 2] = torch.tensor([self.sos_idx] + list(ids) + [self.eos_idx], dtype=torch.int64)
+        source = source.to(self.device) # (b, src_len)
+        source_mask = (source != self.pad_idx).unsqueeze(1).unsqueeze(1) # (b, 1, 1, src_len)
+        return source, source_mask
+
+    @torch.no_grad()
+    def translate_ids(self, batch_ids, beam_size: int=1):
+        source, source_mask = self.make_source(batch_ids)
+        if beam_size > 1:
+            if self.model is None:
+                raise ValueError("Beam search needs the PyTorch model, the onnx backend only decodes greedily")
+            model_out, _ = beam_search(self.model, source, source_mask, self.tokenizer_tgt.token_to_id('[SOS]'), self.tokenizer_tgt.token_to_id('[EOS]'), self.tokenizer_tgt.token_to_id('[PAD]'), beam_size, self.seq_len)
+        elif self.runner is not None:
+            # The step graphs project over the full vocabulary, the shortlist is not used
+            model_out = collect_greedy(self.next_tokens(source, source_mask), source.size(0), self.tokenizer_tgt.token_to_id('[SOS]'), self.tokenizer_tgt.token_to_id('[EOS]'), self.tokenizer_tgt.token_to_id('[PAD]'), self.device)
+        else:
+            model_out = batch_greedy_decode(self.model, source, source_mask, self.tokenizer_src, self.tokenizer_tgt, self.seq_len, self.device, self.shortlist)
+        return [self.tokenizer_tgt.decode(row) for row in model_out.cpu().tolist()]
+
+    def translate_batch(self, sentences, beam_size: int=1):
+        return self.translate_ids([self.encode(sentence) for sentence in sentences], beam_size)
+
+    @torch.no_grad()
+    def next_tokens(self, source, source_mask):
+        # Greedy decoding of source, yields the next token of every row at each step: (batch)
+        sos_idx = self.tokenizer_tgt.token_to_id('[SOS]')
+        if self.runner is not None:
+            yield from self.runner.generate(source, source_mask, sos_idx, self.tokenizer_tgt.token_to_id('[PAD]'))
+        else:
+            yield from greedy_steps(self.model, source, source_mask, sos_idx, self.seq_len, self.shortlist)
 
-    # Load the pretrained weights
-    model_filename = latest_weights_file_path(config)
-    state = torch.load(model_filename)
-    model.load_state_dict(state['model_state_dict'])
+    @torch.no_grad()
+    def stream(self, sentence: str, cancel=None):
+        # Greedy decoding yielding (token id, text) for every generated token, the text being what the token adds
+        # to the detokenized translation. Decoding stops after the current step when the generator is closed
+        # (e.g. the client disconnected) or when the cancel event, a threading.Event, is set
+        eos_idx = self.tokenizer_tgt.token_to_id('[EOS]')
+        source, source_mask = self.make_source([self.encode(sentence)])
+
+        started = False
+        for next_word in self.next_tokens(source, source_mask):
+            if cancel is not None and cancel.is_set():
+                return
+            token = next_word.item()
+            if token == eos_idx:
+                return
+
+            # The WordLevel decoder joins the words with single spaces: each token adds a space, except the
+            # first one, and its word. Special tokens decode to nothing and add nothing
+            word = self.tokenizer_tgt.decode([token])
+            piece = (' ' if started and word else '') + word
+            started = started or bool(word)
+            yield token, piece
+
+    async def astream(self, sentence: str):
+        # Async iterator over stream(): every decoding step runs in the default executor so that the event loop
+        # keeps serving. Cancelling the consuming task stops the decoding after the current step
+        import asyncio
+        import threading
+        loop = asyncio.get_running_loop()
+        cancel = threading.Event()
+        steps = self.stream(sentence, cancel)
+        done = object()
+        # Step running in the executor, shielded so that it is still tracked when the task is cancelled
+        pending = None
+        try:
+            while True:
+                pending = loop.run_in_executor(None, next, steps, done)
+                step = await asyncio.shield(pending)
+                pending = None
+                if step is done:
+                    return
+                yield step
+        finally:
+            cancel.set()
+            # The generator cannot be closed while a step runs in the executor ("generator already executing"):
+            # it is closed once that step returns
+            if pending is None or pending.done():
+                steps.close()
+            else:
+                pending.add_done_callback(lambda _: steps.close())
+
+_translators = {}
+
+def get_translator(backend: str = None):
+    # The model is loaded once per process and backend, and reused by every call.
+    # backend overrides the inference_backend of the config: 'eager', 'trace', 'compile' or 'onnx'
+    if backend not in _translators:
+        config = get_config()
+        if backend is not None:
+            config['inference_backend'] = backend
+        _translators[backend] = Translator(config)
+    return _translators[backend]
+
+def translate(sentence: str, beam_size: int = 1, backend: str = None):
+    # Define the device, tokenizers, and model
+    translator = get_translator(backend)
+    print("Using device:", translator.device)
+    config = translator.config
 
     # if the sentence is a number use it as an index to the test set
     label = ""
     if type(sentence) == int or sentence.isdigit():
+        from datasets import load_dataset
         id = int(sentence)
         ds = load_dataset(f"{config['datasource']}", f"{config['lang_src']}-{config['lang_tgt']}", split='all')
-        ds = BilingualDataset(ds, tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], config['seq_len'])
-        sentence = ds[id]['src_text']
-        label = ds[id]["tgt_text"]
-    seq_len = config['seq_len']
+        sentence = ds[id]['translation'][config['lang_src']]
+        label = ds[id]['translation'][config['lang_tgt']]
 
-    # translate the sentence
-    model.eval()
-    with torch.no_grad():
-        # Precompute the encoder output and reuse it for every generation step
-        source = tokenizer_src.encode(sentence)
-        source = torch.cat([
-            torch.tensor([tokenizer_src.token_to_id('[SOS]')], dtype=torch.int64), 
-            torch.tensor(source.ids, dtype=torch.int64),
-            torch.tensor([tokenizer_src.token_to_id('[EOS]')], dtype=torch.int64),
-            torch.tensor([tokenizer_src.token_to_id('[PAD]')] * (seq_len - len(source.ids) - 2), dtype=torch.int64)
-        ], dim=0).to(device)
-        source_mask = (source != tokenizer_src.token_to_id('[PAD]')).unsqueeze(0).unsqueeze(0).int().to(device)
-        encoder_output = model.encode(source, source_mask)
-
-        # Initialize the decoder input with the sos token
-        decoder_input = torch.empty(1, 1).fill_(tokenizer_tgt.token_to_id('[SOS]')).type_as(source).to(device)
-
-        # Print the source sentence and target start prompt
-        if label != "": print(f"{f'ID: ':>12}{id}") 
-        print(f"{f'SOURCE: ':>12}{sentence}")
-        if label != "": print(f"{f'TARGET: ':>12}{label}") 
-        print(f"{f'PREDICTED: ':>12}", end='')
-
-        # Generate the translation word by word
-        while decoder_input.size(1) < seq_len:
-            # build mask for target and calculate output
-            decoder_mask = torch.triu(torch.ones((1, decoder_input.size(1), decoder_input.size(1))), diagonal=1).type(torch.int).type_as(source_mask).to(device)
-            out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask)
-
-            # project next token
-            prob = model.project(out[:, -1])
-            _, next_word = torch.max(prob, dim=1)
-            decoder_input = torch.cat([decoder_input, torch.empty(1, 1).type_as(source).fill_(next_word.item()).to(device)], dim=1)
-
-            # print the translated word
-            print(f"{tokenizer_tgt.decode([next_word.item()])}", end=' ')
-
-            # break if we predict the end of sentence token
-            if next_word == tokenizer_tgt.token_to_id('[EOS]'):
-                break
-
-    # convert ids to tokens
-    return tokenizer_tgt.decode(decoder_input[0].tolist())
-    
-#read sentence from argument
-translate(sys.argv[1] if len(sys.argv) > 1 else "I am not a very good a student.")
\ No newline at end of file
+    # Print the source sentence and target start prompt
+    if label != "": print(f"{f'ID: ':>12}{id}")
+    print(f"{f'SOURCE: ':>12}{sentence}")
+    if label != "": print(f"{f'TARGET: ':>12}{label}")
+    print(f"{f'PREDICTED: ':>12}", end='')
+
+    if beam_size > 1:
+        # Beam search only knows the best translation at the end, print it at once
+        translation = translator.translate_batch([sentence], beam_size)[0]
+        print(translation)
+        return translation
+
+    # Generate the translation word by word, printing the words as they come
+    translation = ''
+    for _, piece in translator.stream(sentence):
+        print(piece, end='', flush=True)
+        translation += piece
+    print()
+    return translation
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Translate a sentence, or the sentence of the dataset at an index')
+    parser.add_argument('sentence', nargs='?', default="I am not a very good a student.")
+    parser.add_argument('--beam-size', type=int, default=1)
+    parser.add_argument('--backend', choices=['eager', 'trace', 'compile', 'onnx'], default=None, help='overrides inference_backend of the config')
+    args = parser.parse_args()
+    translate(args.sentence, args.beam_size, args.backend)
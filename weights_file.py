@@ -0,0 +1,69 @@
+import inspect
+import json
+import struct
+
+import numpy as np
+import torch
+
+# Inference-only weights file, in the layout of the safetensors format:
+# an 8 bytes little endian header size, a JSON header giving the dtype, shape and byte range of every tensor,
+# then the raw tensor data. There is no pickle, and the tensors are views of a memory-mapped file:
+# a page is only read when its weights are used, and processes loading the same file share the pages
+
+DTYPES = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+DTYPE_NAMES = {name: dtype for dtype, name in DTYPES.items()}
+
+def save_weights(state_dict, path):
+    # The largest elements first, so that every tensor starts at an offset aligned to its element size
+    names = sorted(state_dict, key=lambda name: -state_dict[name].element_size())
+    header, offset = {}, 0
+    for name in names:
+        tensor = state_dict[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': DTYPES[tensor.dtype], 'shape': list(tensor.shape), 'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    header = json.dumps(header).encode()
+    # Pad the header so that the data starts 8 bytes aligned
+    header += b' ' * (-len(header) % 8)
+
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name in names:
+            tensor = state_dict[name].detach().to('cpu').contiguous()
+            f.write(tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() else b'')
+
+def load_weights(path):
+    # Returns the state dict as tensors viewing the memory-mapped file. The mapping is copy-on-write:
+    # the file is never modified, and only the pages written by this process stop being shared
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size)
+    state_dict = {}
+    for name, info in header.items():
+        start, end = info['data_offsets']
+        tensor = torch.from_numpy(data[start:end]) if end > start else torch.empty(0, dtype=torch.uint8)
+        state_dict[name] = tensor.view(DTYPE_NAMES[info['dtype']]).reshape(info['shape'])
+    return state_dict
+
+def load_model_weights(model, path, device):
+    state_dict = load_weights(path)
+    if torch.device(device).type == 'cpu' and 'assign' in inspect.signature(model.load_state_dict).parameters:
+        # The parameters become the memory-mapped tensors instead of copies of them (torch >= 2.1),
+        # older versions copy them into the parameters
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model.load_state_dict(state_dict)
+    return model